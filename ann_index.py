@@ -0,0 +1,313 @@
+"""
+ann_index.py
+------------
+On-disk IVF (inverted file) index over a collection's embeddings, used by
+redis_rag_setup when Redis is unreachable. Pure NumPy, no extra dependencies.
+
+Layout of an index directory (one per list key):
+
+  manifest.json  dim, row count, nlist, the Redis epoch / last_seq it mirrors
+  vectors.f32    L2-normalized float32 rows, appended in place
+  assign.i32     IVF list of every row (-1 once the row is superseded)
+  centroids.npy  k-means centroids
+  ids.json       doc id -> row
+  docs.jsonl     {"id", "content", "metadata"} per row, docs.idx = byte offsets
+
+vectors.f32 / assign.i32 / docs.idx are opened with np.memmap (docs.jsonl
+with mmap, in the same open() so offsets and documents always come from the
+same build), so every worker on the host shares the same page-cache pages instead of holding its
+own copy. Writers append rows assigned to the nearest existing centroid and
+re-train from scratch (written to a temp dir and swapped in) only when the
+index has grown well past what the centroids were trained on or after a
+delete. Readers re-open whenever manifest.json changes.
+"""
+
+import os
+import json
+import fcntl
+import mmap
+import shutil
+import threading
+from contextlib import contextmanager
+from typing import Any, Dict, Iterable, List, Optional
+
+import numpy as np
+
+
+ANN_NPROBE = int(os.getenv("RAG_ANN_NPROBE", "8"))
+ANN_KMEANS_ITERS = int(os.getenv("RAG_ANN_KMEANS_ITERS", "10"))
+ANN_TRAIN_SAMPLE = int(os.getenv("RAG_ANN_TRAIN_SAMPLE", "20000"))
+# Re-train the centroids once the index holds this many times the rows they were trained on
+ANN_RETRAIN_GROWTH = float(os.getenv("RAG_ANN_RETRAIN_GROWTH", "4"))
+
+
+def _normalize(rows: np.ndarray) -> np.ndarray:
+    rows = np.asarray(rows, dtype=np.float32)
+    return rows / np.maximum(np.linalg.norm(rows, axis=-1, keepdims=True), 1e-12)
+
+
+def _nlist_for(n: int) -> int:
+    # Usual sqrt(N) heuristic; tiny collections are a single list (exact search)
+    return max(1, int(np.sqrt(n)))
+
+
+def train_centroids(vectors: np.ndarray, nlist: int, iters: int = ANN_KMEANS_ITERS,
+                    seed: int = 0) -> np.ndarray:
+    """Spherical k-means on (a sample of) the rows"""
+    rng = np.random.default_rng(seed)
+    n = vectors.shape[0]
+    sample = vectors if n <= ANN_TRAIN_SAMPLE else vectors[np.sort(rng.choice(n, ANN_TRAIN_SAMPLE, replace=False))]
+    sample = np.asarray(sample, dtype=np.float32)
+    centroids = sample[rng.choice(sample.shape[0], nlist, replace=False)].copy()
+    for _ in range(iters):
+        assign = np.argmax(sample @ centroids.T, axis=1)
+        for c in range(nlist):
+            members = sample[assign == c]
+            if len(members):
+                centroids[c] = members.sum(axis=0)
+            else:
+                # Re-seed empty lists with a random row
+                centroids[c] = sample[rng.integers(sample.shape[0])]
+        centroids = _normalize(centroids)
+    return centroids
+
+
+def _assign(vectors: np.ndarray, centroids: np.ndarray, block: int = 8192) -> np.ndarray:
+    out = np.empty(vectors.shape[0], dtype=np.int32)
+    for start in range(0, vectors.shape[0], block):
+        out[start:start + block] = np.argmax(np.asarray(vectors[start:start + block]) @ centroids.T, axis=1)
+    return out
+
+
+class IVFIndex:
+    """Reader/writer for one index directory.
+
+    search() is safe to call from many threads; writes take an flock on the
+    directory so concurrent workers syncing from Redis don't interleave.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.RLock()
+        self._stamp = None
+        self.manifest: Dict[str, Any] = {}
+
+    # -- files -------------------------------------------------------------
+
+    def _file(self, name: str, root: Optional[str] = None) -> str:
+        return os.path.join(root or self.path, name)
+
+    @contextmanager
+    def _write_lock(self):
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        with open(f"{self.path}.lock", "w") as fh:
+            fcntl.flock(fh, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(fh, fcntl.LOCK_UN)
+
+    def _write_manifest(self, manifest: Dict[str, Any], root: Optional[str] = None) -> None:
+        tmp = self._file("manifest.json.tmp", root)
+        with open(tmp, "w") as fh:
+            json.dump(manifest, fh)
+        os.replace(tmp, self._file("manifest.json", root))
+
+    def exists(self) -> bool:
+        return os.path.exists(self._file("manifest.json"))
+
+    def open(self) -> bool:
+        """(Re-)map the files if the manifest changed; returns False when there is no index"""
+        try:
+            st = os.stat(self._file("manifest.json"))
+        except FileNotFoundError:
+            return False
+        stamp = (st.st_ino, st.st_mtime_ns)
+        with self._lock:
+            if stamp == self._stamp:
+                return True
+            with open(self._file("manifest.json")) as fh:
+                manifest = json.load(fh)
+            n, dim = manifest["count"], manifest["dim"]
+            if n:
+                self.vectors = np.memmap(self._file("vectors.f32"), dtype=np.float32, mode="r", shape=(n, dim))
+                self.assign = np.memmap(self._file("assign.i32"), dtype=np.int32, mode="r", shape=(n,))
+                self.doc_offsets = np.memmap(self._file("docs.idx"), dtype=np.int64, mode="r", shape=(n,))
+                # Mapped now, not re-opened by path per search: build() may swap in a new
+                # directory, and the offsets above only fit this docs.jsonl
+                with open(self._file("docs.jsonl"), "rb") as fh:
+                    self.docs = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                self.vectors = np.empty((0, dim), dtype=np.float32)
+                self.assign = np.empty(0, dtype=np.int32)
+                self.doc_offsets = np.empty(0, dtype=np.int64)
+                self.docs = b""
+            self.centroids = np.load(self._file("centroids.npy"))
+            # Rows grouped by list: order[offsets[c]:offsets[c + 1]] are the rows of list c
+            assign = np.asarray(self.assign)
+            self.order = np.argsort(assign, kind="stable")
+            self.offsets = np.searchsorted(assign[self.order], np.arange(len(self.centroids) + 1))
+            self.manifest = manifest
+            self._stamp = stamp
+            st = os.stat(self._file("manifest.json"))
+            if (st.st_ino, st.st_mtime_ns) != stamp:
+                # Swapped by build() while mapping; map the new one consistently
+                return self.open()
+        return True
+
+    # -- reads -------------------------------------------------------------
+
+    @staticmethod
+    def _read_docs(rows: Iterable[int], doc_offsets: np.ndarray, docs_map) -> List[Dict[str, Any]]:
+        docs = []
+        for row in rows:
+            start = int(doc_offsets[row])
+            docs.append(json.loads(docs_map[start:docs_map.find(b"\n", start)]))
+        return docs
+
+    def search(self, query_embedding, k: int, nprobe: int = ANN_NPROBE,
+               where=None, include_vectors: bool = False) -> List[Dict[str, Any]]:
+        """Approximate top-k by cosine similarity over the nprobe closest lists.
+
+        where, if given, is a predicate on a doc's metadata; matches are found
+        by over-fetching and filtering the ranked rows. include_vectors adds
+        each hit's normalized row under "embedding".
+        """
+        if not self.open():
+            return []
+        with self._lock:
+            vectors, assign, order, offsets = self.vectors, self.assign, self.order, self.offsets
+            centroids, doc_offsets, docs_map = self.centroids, self.doc_offsets, self.docs
+        if vectors.shape[0] == 0:
+            return []
+
+        q = _normalize(query_embedding)
+        probe = np.argsort(-(centroids @ q))[:nprobe]
+        rows = np.concatenate([order[offsets[c]:offsets[c + 1]] for c in probe])
+        rows.sort()
+        # Rows superseded since this reader mapped the files
+        rows = rows[np.asarray(assign[rows]) >= 0]
+        if rows.size == 0:
+            return []
+        scores = np.asarray(vectors[rows]) @ q
+
+        fetch = min(rows.size, k if where is None else k * 4)
+        top = np.argpartition(-scores, fetch - 1)[:fetch] if fetch < rows.size else np.arange(rows.size)
+        top = top[np.argsort(-scores[top])]
+        results = []
+        for row, doc, score in zip(rows[top], self._read_docs(rows[top], doc_offsets, docs_map), scores[top]):
+            if where is not None and not where(doc.get("metadata") or {}):
+                continue
+            doc["score"] = float(score)
+            if include_vectors:
+                doc["embedding"] = np.array(vectors[row])
+            results.append(doc)
+            if len(results) == k:
+                break
+        return results
+
+    # -- writes ------------------------------------------------------------
+
+    def build(self, records: Iterable[Dict[str, Any]], dim: int, state: Dict[str, Any]) -> int:
+        """Write a fresh index from records ({id, content, metadata, embedding}).
+
+        The new index is written beside the old one and swapped in, so
+        readers never see a half-written directory. state (e.g. the Redis
+        epoch and last_seq mirrored) is stored in the manifest.
+        """
+        with self._write_lock():
+            tmp = f"{self.path}.build"
+            shutil.rmtree(tmp, ignore_errors=True)
+            os.makedirs(tmp)
+            ids: Dict[str, int] = {}
+            count = 0
+            with open(self._file("vectors.f32", tmp), "wb") as vf, \
+                    open(self._file("docs.jsonl", tmp), "wb") as df, \
+                    open(self._file("docs.idx", tmp), "wb") as xf:
+                for rec in records:
+                    if rec["id"] in ids:
+                        continue
+                    ids[rec["id"]] = count
+                    vf.write(_normalize(rec["embedding"]).tobytes())
+                    xf.write(np.int64(df.tell()).tobytes())
+                    df.write(json.dumps({"id": rec["id"], "content": rec["content"],
+                                         "metadata": rec["metadata"]}).encode("utf-8") + b"\n")
+                    count += 1
+
+            nlist = _nlist_for(count)
+            if count:
+                vectors = np.memmap(self._file("vectors.f32", tmp), dtype=np.float32, mode="r", shape=(count, dim))
+                centroids = train_centroids(vectors, nlist)
+                _assign(vectors, centroids).tofile(self._file("assign.i32", tmp))
+                del vectors
+            else:
+                centroids = np.zeros((1, dim), dtype=np.float32)
+                open(self._file("assign.i32", tmp), "wb").close()
+            np.save(self._file("centroids.npy", tmp), centroids)
+            with open(self._file("ids.json", tmp), "w") as fh:
+                json.dump(ids, fh)
+            self._write_manifest({**state, "dim": dim, "count": count, "live": count,
+                                  "trained_count": count, "nlist": len(centroids)}, tmp)
+
+            old = f"{self.path}.old"
+            shutil.rmtree(old, ignore_errors=True)
+            if os.path.exists(self.path):
+                os.rename(self.path, old)
+            os.rename(tmp, self.path)
+            shutil.rmtree(old, ignore_errors=True)
+            return count
+
+    def append(self, records: List[Dict[str, Any]], state: Dict[str, Any]) -> int:
+        """Add (or replace) records in place; returns how many rows were written.
+
+        New rows go to the nearest existing centroid. A replaced id keeps its
+        old row on disk, marked -1 in assign.i32.
+        """
+        # Same id twice in one batch: last one wins
+        records = list({rec["id"]: rec for rec in records}.values())
+        if not records:
+            return 0
+        with self._write_lock():
+            with open(self._file("manifest.json")) as fh:
+                manifest = json.load(fh)
+            with open(self._file("ids.json")) as fh:
+                ids = json.load(fh)
+            centroids = np.load(self._file("centroids.npy"))
+            dim, count = manifest["dim"], manifest["count"]
+
+            vectors = _normalize(np.vstack([rec["embedding"] for rec in records]))
+            assign = _assign(vectors, centroids)
+            superseded = [ids[rec["id"]] for rec in records if rec["id"] in ids]
+            if superseded and count:
+                old = np.memmap(self._file("assign.i32"), dtype=np.int32, mode="r+", shape=(count,))
+                old[superseded] = -1
+                old.flush()
+                del old
+
+            with open(self._file("vectors.f32"), "ab") as vf, \
+                    open(self._file("assign.i32"), "ab") as af, \
+                    open(self._file("docs.jsonl"), "ab") as df, \
+                    open(self._file("docs.idx"), "ab") as xf:
+                for i, rec in enumerate(records):
+                    ids[rec["id"]] = count + i
+                    vf.write(vectors[i].tobytes())
+                    af.write(assign[i].tobytes())
+                    xf.write(np.int64(df.tell()).tobytes())
+                    df.write(json.dumps({"id": rec["id"], "content": rec["content"],
+                                         "metadata": rec["metadata"]}).encode("utf-8") + b"\n")
+
+            tmp = self._file("ids.json.tmp")
+            with open(tmp, "w") as fh:
+                json.dump(ids, fh)
+            os.replace(tmp, self._file("ids.json"))
+            self._write_manifest({**manifest, **state, "dim": dim, "count": count + len(records),
+                                  "live": len(ids)})
+            return len(records)
+
+    def needs_rebuild(self) -> bool:
+        """True once the centroids are stale or superseded rows dominate the files"""
+        if not self.open():
+            return True
+        m = self.manifest
+        return (m["count"] > ANN_RETRAIN_GROWTH * max(m["trained_count"], 1)
+                or m["live"] * 2 < m["count"])
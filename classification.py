@@ -1,6 +1,6 @@
 from rapidfuzz import fuzz, process
 from document_processing_services import plumber_extract, tessaract_ocr
-from sentence_transformers import SentenceTransformer
+from embedding_service import encode_many
 from sklearn.linear_model import LogisticRegression
 import logging
 import joblib
@@ -155,19 +155,19 @@ def detect_document_type(pdf_path, threshold=50):
 # # EMBEDDINGS + ML CLASSIFIER
 # # -----------------------------
 # class HybridClassifier:
-#     def __init__(self, model_name="all-MiniLM-L6-v2"):
-#         self.model = SentenceTransformer(model_name)
+#     def __init__(self):
+#         # Embeddings come from the shared embedding_service model
 #         self.clf = None
 
 #     def train(self, docs, labels):
-#         embeddings = self.model.encode(docs)
+#         embeddings = encode_many(docs)
 #         self.clf = LogisticRegression(max_iter=500)
 #         self.clf.fit(embeddings, labels)
 
 #     def predict(self, text):
 #         if not self.clf:
 #             raise ValueError("Classifier not trained!")
-#         embedding = self.model.encode([text])
+#         embedding = encode_many([text])
 #         return self.clf.predict(embedding)[0], self.clf.predict_proba(embedding).max()
 
 #     def save(self, path):
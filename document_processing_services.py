@@ -7,6 +7,7 @@ from dotenv import load_dotenv
 import fitz  # PyMuPDF
 from PyPDF2 import PdfReader, PdfWriter # For PDF manipulation
 from PIL import Image
+from src.ocr_cache import get_ocr_cache, tesseract_version
 
 # Loading the .env file to get the API key
 load_dotenv()
@@ -62,13 +63,21 @@ def tessaract_ocr(pdf_path: str) -> str:
     doc = fitz.open(pdf_path)
     full_text: str = ""
 
-    for page_num in range(len(doc)):
-        page = doc.load_page(page_num)
-        pix = page.get_pixmap(dpi=300)  # high resolution for better OCR
-        img_data = pix.tobytes("png")
+    # Pages already OCR'd (same page content, DPI and Tesseract version) come from the cache
+    cache = get_ocr_cache()
+    cached_pages = cache.document(pdf_path, 300, f"{tesseract_version()}-eng") if cache else None
 
-        image = Image.open(io.BytesIO(img_data))
-        text = pytesseract.image_to_string(image, lang="eng")
+    for page_num in range(len(doc)):
+        text = cached_pages.get(page_num) if cached_pages else None
+        if text is None:
+            page = doc.load_page(page_num)
+            pix = page.get_pixmap(dpi=300)  # high resolution for better OCR
+            img_data = pix.tobytes("png")
+
+            image = Image.open(io.BytesIO(img_data))
+            text = pytesseract.image_to_string(image, lang="eng")
+            if cached_pages:
+                cached_pages.put(page_num, text)
 
         full_text += f"\n--- Page {page_num + 1} ---\n{text}"
 
@@ -0,0 +1,194 @@
+"""
+embedding_service.py
+--------------------
+One SentenceTransformer per process, shared by rag_setup, redis_rag_setup and
+classification. The model is loaded on first use (thread-safe), and can be run
+through ONNX Runtime or int8-quantized for faster CPU inference:
+
+  EMBED_MODEL      model name or path (default all-MiniLM-L6-v2)
+  EMBED_BACKEND    torch | torch-int8 | onnx | onnx-int8 (default torch)
+  EMBED_ONNX_FILE  ONNX file inside the model repo for the onnx-int8 backend
+  EMBED_DEVICE     e.g. cpu or cuda (default: let sentence-transformers pick)
+  EMBED_BATCH_SIZE default batch size for encode_many
+  EMBED_BATCH_WINDOW_MS / EMBED_MAX_BATCH
+                   micro-batching window and cap for encode_async
+
+Concurrent single-text requests go through EmbeddingBatcher: texts arriving
+within a few milliseconds are encoded as one batch in a worker thread and
+each caller's future is resolved with its own row.
+"""
+
+import os
+import asyncio
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import List, Optional, TYPE_CHECKING
+
+import numpy as np
+
+if TYPE_CHECKING:
+    # Importing sentence_transformers pulls in torch; only do it when the model is needed
+    from sentence_transformers import SentenceTransformer
+
+
+EMBED_MODEL = os.getenv("EMBED_MODEL", "all-MiniLM-L6-v2")
+EMBED_BACKEND = os.getenv("EMBED_BACKEND", "torch").lower()
+EMBED_ONNX_FILE = os.getenv("EMBED_ONNX_FILE", "onnx/model_quint8_avx2.onnx")
+EMBED_DEVICE = os.getenv("EMBED_DEVICE") or None
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", "32"))
+EMBED_BATCH_WINDOW_MS = float(os.getenv("EMBED_BATCH_WINDOW_MS", "5"))
+EMBED_MAX_BATCH = int(os.getenv("EMBED_MAX_BATCH", "64"))
+
+_embedder: "SentenceTransformer" = None
+_embedder_lock = threading.Lock()
+
+
+def _load_model() -> "SentenceTransformer":
+    from sentence_transformers import SentenceTransformer
+
+    if EMBED_BACKEND == "onnx":
+        return SentenceTransformer(EMBED_MODEL, device=EMBED_DEVICE, backend="onnx")
+    if EMBED_BACKEND == "onnx-int8":
+        # Pre-quantized ONNX export shipped in the model repo
+        return SentenceTransformer(EMBED_MODEL, device=EMBED_DEVICE, backend="onnx",
+                                   model_kwargs={"file_name": EMBED_ONNX_FILE})
+
+    model = SentenceTransformer(EMBED_MODEL, device=EMBED_DEVICE)
+    if EMBED_BACKEND == "torch-int8":
+        # Dynamic int8 quantization of the Linear layers (CPU only)
+        import torch
+        model = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    return model
+
+
+def get_embedder() -> "SentenceTransformer":
+    global _embedder
+    if _embedder is None:
+        with _embedder_lock:
+            if _embedder is None:
+                _embedder = _load_model()
+    return _embedder
+
+
+def encode_many(texts: List[str], batch_size: Optional[int] = None) -> np.ndarray:
+    """Encode texts in batches; returns a float32 array of shape (len(texts), dim)"""
+    if not texts:
+        return np.empty((0, 0), dtype=np.float32)
+    vectors = get_embedder().encode(list(texts), batch_size=batch_size or EMBED_BATCH_SIZE,
+                                    convert_to_numpy=True, show_progress_bar=False)
+    return np.asarray(vectors, dtype=np.float32)
+
+
+def encode(text: str) -> np.ndarray:
+    """Encode a single text; returns a float32 vector"""
+    return encode_many([text])[0]
+
+
+def count_tokens(texts: List[str]) -> List[int]:
+    """Word-piece counts per text from the model's fast tokenizer (special tokens excluded)"""
+    if not texts:
+        return []
+    tokenizer = get_embedder().tokenizer
+    encoded = tokenizer(list(texts), add_special_tokens=False, verbose=False)
+    return [len(ids) for ids in encoded["input_ids"]]
+
+
+def warm_up_models(background: bool = True) -> Optional[threading.Thread]:
+    """Load the embedding model (and run one encode) ahead of the first request.
+
+    With background=True this returns immediately and the load happens in a
+    daemon thread, so server startup is not blocked.
+    """
+    def _load():
+        t0 = time.time()
+        try:
+            encode("warm up")
+            print(f"✓ Embedding model {EMBED_MODEL} ({EMBED_BACKEND}) ready in {time.time() - t0:.2f}s")
+        except Exception as e:
+            print(f"Embedding model warm-up failed: {e}")
+
+    if not background:
+        _load()
+        return None
+    thread = threading.Thread(target=_load, name="embedder-warmup", daemon=True)
+    thread.start()
+    return thread
+
+
+class EmbeddingBatcher:
+    """Micro-batches single-text encode requests from many callers.
+
+    The first text that arrives opens a window of window_ms; everything
+    submitted before it closes (up to max_batch texts) is encoded with one
+    encode_many call on the worker thread.
+    """
+
+    def __init__(self, window_ms: float = EMBED_BATCH_WINDOW_MS, max_batch: int = EMBED_MAX_BATCH):
+        self.window = window_ms / 1000.0
+        self.max_batch = max_batch
+        self._queue: "queue.Queue" = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name="embedding-batcher", daemon=True)
+        self._thread.start()
+
+    def submit(self, text: str) -> Future:
+        fut: Future = Future()
+        self._queue.put((text, fut))
+        return fut
+
+    def shutdown(self) -> None:
+        self._queue.put(None)
+        self._thread.join()
+
+    def _run(self) -> None:
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            batch = [item]
+            deadline = time.monotonic() + self.window
+            stop = False
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if item is None:
+                    stop = True
+                    break
+                batch.append(item)
+
+            # Callers that gave up (cancelled futures) don't need encoding
+            batch = [(text, fut) for text, fut in batch if fut.set_running_or_notify_cancel()]
+            if batch:
+                try:
+                    vectors = encode_many([text for text, _ in batch])
+                    for (_, fut), vec in zip(batch, vectors):
+                        fut.set_result(vec)
+                except Exception as e:
+                    for _, fut in batch:
+                        fut.set_exception(e)
+            if stop:
+                return
+
+
+_batcher: Optional[EmbeddingBatcher] = None
+_batcher_lock = threading.Lock()
+
+
+def get_batcher() -> EmbeddingBatcher:
+    global _batcher
+    if _batcher is None:
+        with _batcher_lock:
+            if _batcher is None:
+                _batcher = EmbeddingBatcher()
+    return _batcher
+
+
+async def encode_async(text: str) -> np.ndarray:
+    """Encode one text without blocking the event loop, batched with concurrent callers"""
+    return await asyncio.wrap_future(get_batcher().submit(text))
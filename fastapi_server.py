@@ -1,7 +1,8 @@
-from fastapi import FastAPI, HTTPException, Request, UploadFile
+from fastapi import FastAPI, HTTPException, Request, UploadFile, Form
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
 from fastapi.responses import FileResponse, JSONResponse
+from fastapi.concurrency import run_in_threadpool
 from mistralai import Mistral
 from groq import Groq
 import boto3
@@ -49,8 +50,13 @@ from json_mapper import mapper,  sanitize_json_dict, sanitize_json, reverse_tran
 from excel_generator import excel_template_downlaoder, process_json_to_excel, upload_to_s3
 # from rapid_ocr import run_rapidocr #, pdf_utils, ocr_rapid, layout
 from src import run_rapid4
+from src.pdf_utils import shutdown_render_pool
 # from RAPID_OCR_FINAL import run_rapid4
-from redis_rag_setup import rag_invoice_prompt_redis
+from redis_rag_setup import (
+    rag_invoice_prompt_redis_async, embedding_cache_stats, close_async_redis, query_stats_summary,
+    INVOICE_LIST_KEY, DO_LIST_KEY,
+)
+from embedding_service import warm_up_models
 
 # Load environment variables (.env file contains AWS credentials and API Keys)
 load_dotenv()
@@ -87,6 +93,27 @@ s3_client = boto3.client(
     region_name=region_name,
 )
 
+# Models load lazily on first use; RAG_WARMUP=1 preloads the embedder in a
+# background thread at startup so the first RAG request doesn't pay for it.
+# OCR_WARMUP=1 likewise starts the RapidOCR worker pool before the first upload.
+@app.on_event("startup")
+async def warm_up_event():
+    if os.getenv("RAG_WARMUP", "0") == "1":
+        warm_up_models(background=True)
+    if os.getenv("OCR_WARMUP", "0") == "1":
+        run_rapid4.warm_up_ocr_pool(wait=False)
+
+
+@app.on_event("shutdown")
+async def close_redis_event():
+    await close_async_redis()
+
+
+@app.on_event("shutdown")
+async def close_ocr_pool_event():
+    await run_in_threadpool(run_rapid4.shutdown_ocr_pool)
+    await run_in_threadpool(shutdown_render_pool)
+
 # # Startup event to establish SSH tunnel and create PostgreSQL connection pool
 # @app.on_event("startup")
 # async def startup_event():
@@ -445,7 +472,10 @@ async def process_pdf_upload(file: UploadFile):
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.post("/process-pdf-upload-redis")
-async def process_pdf_upload_redis(file: UploadFile):
+async def process_pdf_upload_redis(
+        file: UploadFile,
+        shippingLineName: Optional[str] = Form(None),
+        currency: Optional[str] = Form(None)):
     try:
         if not file:
             raise HTTPException(status_code=400, detail="No file uploaded")
@@ -474,7 +504,11 @@ async def process_pdf_upload_redis(file: UploadFile):
         if not ocr_text:
             raise HTTPException(status_code=400, detail="Could not extract text from PDF")
         
-        prompt = rag_invoice_prompt_redis(ocr_text)
+        # Known carrier/currency narrows the exemplar search before ranking
+        filters = {k: v for k, v in {"shippingLineName": shippingLineName, "currency": currency}.items() if v}
+        # Encoding is micro-batched with concurrent uploads and retrieval is
+        # awaited on the asyncio Redis pool, so other requests keep being served
+        prompt = await rag_invoice_prompt_redis_async(ocr_text, filters=filters or None)
         logging.info(f"Generated RAG prompt (length: {len(prompt)} chars)")
         
         result = extract(prompt)
@@ -506,6 +540,19 @@ async def process_pdf_upload_redis(file: UploadFile):
             pass
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.get("/rag/embedding-cache")
+async def embedding_cache_endpoint():
+    """Hit/miss counters of the query embedding cache used by the Redis RAG path."""
+    return embedding_cache_stats()
+
+@app.get("/rag/query-stats")
+def query_stats_endpoint(collection: str = "invoice", bins: int = 10):
+    """Score / latency histograms of recent RAG retrievals for the invoice or do collection."""
+    if collection not in ("invoice", "do"):
+        raise HTTPException(status_code=400, detail="collection must be 'invoice' or 'do'")
+    list_key = INVOICE_LIST_KEY if collection == "invoice" else DO_LIST_KEY
+    return query_stats_summary(list_key, bins)
+
 @app.post("/bl-groq")
 async def bl_endpoint(data: BLRequest, request: Request):
     pdf_path = data.pdfPath
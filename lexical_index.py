@@ -0,0 +1,97 @@
+"""
+lexical_index.py
+----------------
+In-memory BM25 inverted index, used by redis_rag_setup next to the vector
+search. Invoices from one carrier share exact tokens (carrier name, IFSC /
+SWIFT codes, form labels) that MiniLM embeddings of noisy OCR text tend to
+blur; BM25 ranks on those directly.
+
+Queries are whole OCR documents, so only the RAG_LEXICAL_QUERY_TERMS rarest
+query terms are scored. Those are the anchors that discriminate between
+carriers; terms found in most documents add almost nothing to BM25 anyway.
+"""
+
+import os
+import re
+import math
+from collections import Counter
+from typing import Dict, List, Optional, Set, Tuple
+
+
+LEXICAL_QUERY_TERMS = int(os.getenv("RAG_LEXICAL_QUERY_TERMS", "64"))
+
+# Alphanumeric runs; keeps codes such as HDFC0001234 or MSCU1234567 whole
+_TOKEN = re.compile(r"[a-z0-9]{2,}")
+
+
+def tokenize(text: str) -> List[str]:
+    return _TOKEN.findall(text.lower())
+
+
+class BM25Index:
+    """Okapi BM25 over documents keyed by id, with in-place add/replace/remove"""
+
+    def __init__(self, k1: float = 1.2, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.postings: Dict[str, Dict[str, int]] = {}
+        self.doc_terms: Dict[str, Counter] = {}
+        self.doc_len: Dict[str, int] = {}
+        self.total_len = 0
+
+    def __len__(self) -> int:
+        return len(self.doc_len)
+
+    def add(self, doc_id: str, text: str) -> None:
+        if doc_id in self.doc_len:
+            self.remove(doc_id)
+        terms = Counter(tokenize(text))
+        for term, tf in terms.items():
+            self.postings.setdefault(term, {})[doc_id] = tf
+        self.doc_terms[doc_id] = terms
+        self.doc_len[doc_id] = sum(terms.values())
+        self.total_len += self.doc_len[doc_id]
+
+    def remove(self, doc_id: str) -> None:
+        terms = self.doc_terms.pop(doc_id, None)
+        if terms is None:
+            return
+        for term in terms:
+            docs = self.postings[term]
+            docs.pop(doc_id, None)
+            if not docs:
+                del self.postings[term]
+        self.total_len -= self.doc_len.pop(doc_id)
+
+    def search(self, query_text: str, n: int, candidates: Optional[Set[str]] = None,
+               max_terms: int = LEXICAL_QUERY_TERMS) -> List[Tuple[str, float]]:
+        """Top-n (doc_id, score) by BM25; only ids in candidates when given"""
+        total = len(self.doc_len)
+        if total == 0 or n <= 0:
+            return []
+        avgdl = self.total_len / total
+
+        terms = [t for t in set(tokenize(query_text)) if t in self.postings]
+        # Rarest terms first (highest idf); common terms barely move BM25
+        terms.sort(key=lambda t: len(self.postings[t]))
+        scores: Dict[str, float] = {}
+        for term in terms[:max_terms]:
+            docs = self.postings[term]
+            idf = math.log(1.0 + (total - len(docs) + 0.5) / (len(docs) + 0.5))
+            for doc_id, tf in docs.items():
+                if candidates is not None and doc_id not in candidates:
+                    continue
+                norm = tf + self.k1 * (1.0 - self.b + self.b * self.doc_len[doc_id] / avgdl)
+                scores[doc_id] = scores.get(doc_id, 0.0) + idf * tf * (self.k1 + 1.0) / norm
+
+        ranked = sorted(scores.items(), key=lambda item: item[1], reverse=True)
+        return ranked[:n]
+
+
+def reciprocal_rank_fusion(rankings: List[List[str]], k: int = 60) -> List[Tuple[str, float]]:
+    """Fuse ranked id lists: score(d) = sum over lists of 1 / (k + rank of d)"""
+    fused: Dict[str, float] = {}
+    for ranking in rankings:
+        for rank, doc_id in enumerate(ranking, 1):
+            fused[doc_id] = fused.get(doc_id, 0.0) + 1.0 / (k + rank)
+    return sorted(fused.items(), key=lambda item: item[1], reverse=True)
@@ -1,56 +1,104 @@
 import os
 import json
+import argparse
+from concurrent.futures import ThreadPoolExecutor
 from typing import List
 
 import chromadb
-from sentence_transformers import SentenceTransformer
 
 from redis_rag_setup import (
-    upsert_invoice,
-    upsert_do,
+    INVOICE_LIST_KEY,
+    DO_LIST_KEY,
+    bulk_upsert,
+    get_redis,
 )
 
 
+COLLECTIONS = [("invoices", "invoice"), ("dorag", "do")]
+
+
 def fetch_chroma_collection(name: str):
     client = chromadb.PersistentClient(path="./chroma_storage")
     return client.get_or_create_collection(name)
 
 
-def migrate_collection(name: str, kind: str) -> int:
+def _checkpoint_key(name: str) -> str:
+    return f"migrate:checkpoint:{name}"
+
+
+def migrate_collection(name: str, kind: str, page_size: int = 500, batch_size: int = 64,
+                       resume: bool = True) -> int:
+    """Copy one Chroma collection into Redis page by page.
+
+    The offset of the last fully written page is checkpointed in Redis, so an
+    interrupted run picks up from there; the checkpoint is cleared once the
+    whole collection has been copied.
+    """
+    r = get_redis()
     collection = fetch_chroma_collection(name)
-    results = collection.get()
-    ids: List[str] = results.get("ids", [])
-    docs: List[str] = results.get("documents", [])
-    metas: List[dict] = results.get("metadatas", [])
-    embeds = results.get("embeddings", None)
+    list_key = INVOICE_LIST_KEY if kind == "invoice" else DO_LIST_KEY
+
+    offset = 0
+    if resume:
+        saved = r.get(_checkpoint_key(name))
+        offset = int(saved) if saved else 0
+        if offset:
+            print(f"Resuming '{name}' from offset {offset}")
 
     migrated = 0
-    for i, doc_id in enumerate(ids):
-        content = docs[i] if i < len(docs) else ""
-        meta = metas[i] if i < len(metas) else {}
-        embedding = embeds[i] if embeds and i < len(embeds) else None
-        if kind == "invoice":
-            upsert_invoice(doc_id, content, meta, embedding)
-        else:
-            upsert_do(doc_id, content, meta, embedding)
-        migrated += 1
+    while True:
+        # Ask for the stored embeddings so they are reused instead of re-encoded
+        results = collection.get(limit=page_size, offset=offset,
+                                 include=["documents", "metadatas", "embeddings"])
+        ids: List[str] = results.get("ids", [])
+        if not ids:
+            break
+        docs: List[str] = results.get("documents") or []
+        metas: List[dict] = results.get("metadatas") or []
+        embeds = results.get("embeddings", None)
+
+        records = (
+            {
+                "id": doc_id,
+                "content": docs[i] if i < len(docs) else "",
+                "metadata": metas[i] if i < len(metas) else {},
+                "embedding": embeds[i] if embeds is not None and i < len(embeds) else None,
+            }
+            for i, doc_id in enumerate(ids)
+        )
+        migrated += bulk_upsert(records, list_key, batch_size=batch_size, chunk_size=page_size)
+        offset += len(ids)
+        r.set(_checkpoint_key(name), offset)
+        if len(ids) < page_size:
+            break
+
+    r.delete(_checkpoint_key(name))
     return migrated
 
 
 def main():
-    total = 0
-    inv = migrate_collection("invoices", kind="invoice")
-    total += inv
-    print(f"Migrated {inv} records from 'invoices' to Redis.")
+    ap = argparse.ArgumentParser(description="Copy the Chroma RAG collections into Redis")
+    ap.add_argument("--parallel", action="store_true", help="Migrate invoices and dorag concurrently")
+    ap.add_argument("--page-size", type=int, default=500, help="Records read from Chroma and written per round")
+    ap.add_argument("--batch-size", type=int, default=64, help="Encode batch size for records without embeddings")
+    ap.add_argument("--restart", action="store_true", help="Ignore saved checkpoints and start from the beginning")
+    args = ap.parse_args()
+
+    def run(name: str, kind: str) -> int:
+        count = migrate_collection(name, kind, page_size=args.page_size,
+                                   batch_size=args.batch_size, resume=not args.restart)
+        print(f"Migrated {count} records from '{name}' to Redis.")
+        return count
 
-    do = migrate_collection("dorag", kind="do")
-    total += do
-    print(f"Migrated {do} records from 'dorag' to Redis.")
+    if args.parallel:
+        # The collections are independent; threads share one embedder and Redis pool
+        with ThreadPoolExecutor(max_workers=len(COLLECTIONS)) as pool:
+            total = sum(pool.map(lambda c: run(*c), COLLECTIONS))
+    else:
+        total = sum(run(name, kind) for name, kind in COLLECTIONS)
 
     print(f"Done. Total migrated: {total}")
 
 
 if __name__ == "__main__":
     main()
-
-
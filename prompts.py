@@ -1,6 +1,7 @@
 from typing import Optional
 from schemas import INVOICE_JSON_SCHEMA, DO_JSON_SCHEMA, MPCI_JSON_SCHEMA
 from rag_setup import comparison
+from redis_rag_setup import rag_do_prompt_redis
 
 
 def get_invoice_prompt(
@@ -652,42 +653,8 @@ def rag_invoice_prompt(new_ocr_text,tes):
 
 
 def rag_do_prompt(new_ocr_text,tes):
-
-    if new_ocr_text:
-        results=comparison(new_ocr_text,collection_name="dorag")
-        prompt_rag = f"""
-                Refer to the previous similar invoices:
-            1. {results['documents'][0][0]} (Fields: {results['metadatas'][0][0]})
-
-                Give dates in DD-MM-YYYY format
-                NO explanations. JSON ONLY
-                Return ContainerList as a List of Dicitonaries like json format
-                The BL Number is a single alphanumeric number
-                The Seal Number is located directly below the Container Number in the table
-                Only Extract the same fields as in similar documents nothing extra
-
-                Only display those fields which are present
-                The text to be analyzed from the document is below-
-                {new_ocr_text}
-            """
-
-    else:
-        results=comparison(tes,collection_name="dorag")
-        prompt_rag = f"""
-            Refer to the previous similar invoices:
-            1. {results['documents'][0][0]} (Fields: {results['metadatas'][0][0]})
-
-                Give dates in DD-MM-YYYY format
-                NO explanations. JSON ONLY
-                Return ContainerList as a List of Dicitonaries like json format
-                The BL Number is a single alphanumeric number
-                The Seal Number is located directly below the Container Number in the table
-                Only Extract the same fields as in similar documents nothing extra
-
-                Only display those fields which are present
-                The text to be analyzed from the document is below-
-                {tes}
-             """
+    # DO exemplars come from the shared Redis store rather than the local Chroma files
+    prompt_rag = rag_do_prompt_redis(new_ocr_text if new_ocr_text else tes)
 
     print(prompt_rag)
     return prompt_rag
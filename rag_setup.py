@@ -1,18 +1,30 @@
-import chromadb
 import json
-from sentence_transformers import SentenceTransformer
+import threading
 
-embedder = SentenceTransformer('all-MiniLM-L6-v2')
-client = chromadb.PersistentClient(path="./chroma_storage")
+from embedding_service import encode
+
+# The Chroma client (and the shared embedder) are created on first use, not at import
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                import chromadb
+                _client = chromadb.PersistentClient(path="./chroma_storage")
+    return _client
 
 
 def create_collection(name):
     # Create or get a collection
-    collection = client.get_or_create_collection(name)
+    collection = get_client().get_or_create_collection(name)
 
 def enter_information(collection_name,ocr_text,json,ids):
-    embedding = embedder.encode([ocr_text])[0]
-    collection = client.get_or_create_collection(collection_name)
+    embedding = encode(ocr_text)
+    collection = get_client().get_or_create_collection(collection_name)
     collection.add(
     ids=[ids],
     documents=[ocr_text],
@@ -45,10 +57,10 @@ def clear_collection(client, collection_name):
     
 
 def comparison(new_ocr_text,collection_name):
-    new_embedding = embedder.encode([new_ocr_text])[0]
+    new_embedding = encode(new_ocr_text)
 
     # Query similar invoices
-    collection = client.get_or_create_collection(name=collection_name)
+    collection = get_client().get_or_create_collection(name=collection_name)
     results = collection.query(
         query_embeddings=[new_embedding],
         n_results=3
@@ -56,7 +68,7 @@ def comparison(new_ocr_text,collection_name):
     return results
 
 def view_collection(collection_name):
-    collection = client.get_or_create_collection(name=collection_name)
+    collection = get_client().get_or_create_collection(name=collection_name)
     results = collection.get()
     print("IDs:", results['ids'])
 
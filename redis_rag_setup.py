@@ -1,145 +1,1981 @@
 import os
+import re
+import math
+import asyncio
 import numpy as np
 import json
 import pickle
-from typing import Dict, Any, List
-from scipy.spatial.distance import cosine
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Any, Iterable, List, Optional, Set, Tuple, Union
 
-from redis import Redis
-from sentence_transformers import SentenceTransformer
+from redis import Redis, BlockingConnectionPool
+from redis import asyncio as aioredis
+from redis.exceptions import ResponseError, ConnectionError as RedisConnectionError, TimeoutError as RedisTimeoutError
+
+from ann_index import IVFIndex
+from lexical_index import BM25Index, LEXICAL_QUERY_TERMS, reciprocal_rank_fusion, tokenize
+
+# The model itself lives in embedding_service, shared with rag_setup and classification
+from embedding_service import (
+    EMBED_MODEL, get_embedder, encode, encode_many, encode_async, count_tokens, warm_up_models,
+)
 
 
 REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379")
 REDIS_PASSWORD = os.getenv("REDIS_PASSWORD", None)
+REDIS_CONNECT_TIMEOUT = float(os.getenv("REDIS_CONNECT_TIMEOUT", "2"))
+# Connection pools (shared by the sync and asyncio clients' settings)
+REDIS_MAX_CONNECTIONS = int(os.getenv("REDIS_MAX_CONNECTIONS", "32"))
+REDIS_SOCKET_TIMEOUT = float(os.getenv("REDIS_SOCKET_TIMEOUT", "5"))
+REDIS_HEALTH_CHECK_INTERVAL = int(os.getenv("REDIS_HEALTH_CHECK_INTERVAL", "30"))
 INVOICE_LIST_KEY = os.getenv("REDIS_INVOICE_LIST", "invoices_list")
 DO_LIST_KEY = os.getenv("REDIS_DO_LIST", "dorag_list")
-EMBED_MODEL = os.getenv("EMBED_MODEL", "all-MiniLM-L6-v2")
 EMBED_DIM = int(os.getenv("EMBED_DIM", "384"))
+# auto: use the RediSearch vector index when the server has it, else scan the list
+# index: always use the vector index / scan: never use it
+SEARCH_MODE = os.getenv("REDIS_SEARCH_MODE", "auto").lower()
+VECTOR_ALGORITHM = os.getenv("REDIS_VECTOR_ALGORITHM", "HNSW").upper()  # HNSW or FLAT
+HNSW_M = int(os.getenv("REDIS_HNSW_M", "16"))
+HNSW_EF_CONSTRUCTION = int(os.getenv("REDIS_HNSW_EF_CONSTRUCTION", "200"))
+HNSW_EF_RUNTIME = int(os.getenv("REDIS_HNSW_EF_RUNTIME", "10"))
+# float32 (1.5 KB per 384-dim vector), float16 (768 B) or int8 (384 B + scale)
+STORAGE_DTYPE = os.getenv("EMBED_STORAGE_DTYPE", "float32").lower()
+
+# Metadata fields with a tag-set secondary index, usable as query filters
+FILTER_FIELDS = [f.strip() for f in os.getenv(
+    "REDIS_FILTER_FIELDS", "shippingLineName,currency,invoiceType,type").split(",") if f.strip()]
+# Chunked indexing: off, or split content into token-bounded windows of whole
+# pages / paragraphs, one vector per chunk, scores aggregated per document
+CHUNK_MODE = os.getenv("RAG_CHUNK_MODE", "off").lower()  # off | page | paragraph
+CHUNK_MAX_TOKENS = int(os.getenv("RAG_CHUNK_MAX_TOKENS", "256"))
+CHUNK_MAX_CHUNKS = int(os.getenv("RAG_CHUNK_MAX_CHUNKS", "16"))
+CHUNK_AGGREGATE = os.getenv("RAG_CHUNK_AGGREGATE", "max").lower()  # max | mean
+CHUNK_OVERSAMPLE = int(os.getenv("RAG_CHUNK_OVERSAMPLE", "4"))
+# Query embedding cache: in-process LRU, plus a shared Redis tier when the TTL is > 0
+QUERY_CACHE_SIZE = int(os.getenv("EMBED_CACHE_SIZE", "256"))
+QUERY_CACHE_TTL = int(os.getenv("EMBED_CACHE_TTL", "0"))
+
+# Prompt exemplars: up to RAG_EXEMPLAR_K picked by MMR out of RAG_EXEMPLAR_CANDIDATES
+# nearest documents, within RAG_EXEMPLAR_TOKEN_BUDGET tokens of exemplar text
+EXEMPLAR_K = int(os.getenv("RAG_EXEMPLAR_K", "3"))
+EXEMPLAR_CANDIDATES = int(os.getenv("RAG_EXEMPLAR_CANDIDATES", "8"))
+EXEMPLAR_TOKEN_BUDGET = int(os.getenv("RAG_EXEMPLAR_TOKEN_BUDGET", "1500"))
+MMR_LAMBDA = float(os.getenv("RAG_MMR_LAMBDA", "0.7"))  # 1.0 = pure relevance
+# Retention: cap each collection at RAG_MAX_DOCS documents (0 = unbounded) by
+# evicting the least recently retrieved ones, and drop documents neither
+# written nor retrieved for RAG_DOC_TTL seconds (0 = never). Pinned documents
+# are exempt. Evictions free RAG_EVICT_SLACK of the cap at once, so in-process
+# matrices reload once per batch rather than on every insert.
+MAX_DOCS = int(os.getenv("RAG_MAX_DOCS", "0"))
+DOC_TTL = int(os.getenv("RAG_DOC_TTL", "0"))
+EVICT_SLACK = float(os.getenv("RAG_EVICT_SLACK", "0.1"))
+# Per-query telemetry (top-1 score, candidates, encode/search time) kept in a
+# capped Redis stream per collection
+QUERY_STATS = os.getenv("RAG_QUERY_STATS", "1") == "1"
+QUERY_STATS_MAXLEN = int(os.getenv("RAG_QUERY_STATS_MAXLEN", "10000"))
+# Hybrid retrieval: fuse the vector ranking with a BM25 ranking over stored
+# content (reciprocal rank fusion). With the vector index, BM25 comes from
+# RediSearch's full-text index; in scan mode from an in-process index.
+# RAG_LEXICAL_PREFILTER > 0 additionally limits the vectors scored (the KNN
+# query or the in-process scan) to the top-N BM25 matches.
+HYBRID = os.getenv("RAG_HYBRID", "0") == "1"
+HYBRID_OVERSAMPLE = int(os.getenv("RAG_HYBRID_OVERSAMPLE", "4"))
+RRF_K = int(os.getenv("RAG_RRF_K", "60"))
+LEXICAL_PREFILTER = int(os.getenv("RAG_LEXICAL_PREFILTER", "0"))
+# How long a process trusts its view of which namespace is active (see resolve_namespace)
+NAMESPACE_CACHE_SECONDS = float(os.getenv("RAG_NAMESPACE_CACHE_SECONDS", "5"))
+# Offline fallback: an on-disk IVF index per collection under this directory,
+# synced from Redis every RAG_ANN_SYNC_INTERVAL seconds (disabled when unset)
+ANN_DIR = os.getenv("RAG_ANN_DIR", "")
+ANN_SYNC_INTERVAL = int(os.getenv("RAG_ANN_SYNC_INTERVAL", "300"))
+# After a connection failure go straight to the offline index for this long
+REDIS_RETRY_AFTER = int(os.getenv("REDIS_RETRY_AFTER", "30"))
+
+_NUMPY_DTYPES = {"float32": "<f4", "float16": "<f2", "int8": "i1"}
+_INDEX_TYPES = {"float32": "FLOAT32", "float16": "FLOAT16", "int8": "INT8"}
 
 
 _redis_client: Redis = None
-_embedder: SentenceTransformer = None
+_async_redis_client: "aioredis.Redis" = None
+_index_ready: Dict[str, bool] = {}
+_query_cache: "OrderedDict[str, np.ndarray]" = OrderedDict()
+_query_cache_lock = threading.Lock()
+_query_cache_stats = {"hits": 0, "redis_hits": 0, "misses": 0}
+_redis_down_until = 0.0
+_offline_indexes: Dict[str, IVFIndex] = {}
+_offline_synced: Dict[str, float] = {}
+_offline_sync_lock = threading.Lock()
+_namespace_cache: Dict[str, Tuple[float, str, Optional[str]]] = {}
+
+
+def _pool_kwargs() -> Dict[str, Any]:
+    return {
+        "password": REDIS_PASSWORD,
+        "max_connections": REDIS_MAX_CONNECTIONS,
+        "timeout": REDIS_SOCKET_TIMEOUT,  # wait for a free connection
+        "socket_timeout": REDIS_SOCKET_TIMEOUT,
+        "socket_connect_timeout": REDIS_CONNECT_TIMEOUT,
+        "health_check_interval": REDIS_HEALTH_CHECK_INTERVAL,
+    }
 
 
 def get_redis() -> Redis:
     global _redis_client
     if _redis_client is None:
-        _redis_client = Redis.from_url(REDIS_URL, password=REDIS_PASSWORD, decode_responses=False)
+        pool = BlockingConnectionPool.from_url(REDIS_URL, **_pool_kwargs())
+        _redis_client = Redis(connection_pool=pool, decode_responses=False)
     return _redis_client
 
 
-def get_embedder() -> SentenceTransformer:
-    global _embedder
-    if _embedder is None:
-        _embedder = SentenceTransformer(EMBED_MODEL)
-    return _embedder
+def get_async_redis() -> "aioredis.Redis":
+    """asyncio client for use inside async handlers; bound to the running event loop"""
+    global _async_redis_client
+    if _async_redis_client is None:
+        pool = aioredis.BlockingConnectionPool.from_url(REDIS_URL, **_pool_kwargs())
+        _async_redis_client = aioredis.Redis(connection_pool=pool, decode_responses=False)
+    return _async_redis_client
+
+
+async def close_async_redis() -> None:
+    """Release the asyncio pool (call from the app's shutdown hook)"""
+    global _async_redis_client
+    if _async_redis_client is not None:
+        await _async_redis_client.aclose()
+        _async_redis_client = None
+
+
+def _remember_query(key: str, vec: np.ndarray) -> None:
+    with _query_cache_lock:
+        _query_cache[key] = vec
+        _query_cache.move_to_end(key)
+        while len(_query_cache) > QUERY_CACHE_SIZE:
+            _query_cache.popitem(last=False)
+
+
+def _cached_query(key: str) -> Optional[np.ndarray]:
+    """Look a query embedding up in the local LRU, then the shared Redis tier"""
+    with _query_cache_lock:
+        vec = _query_cache.get(key)
+        if vec is not None:
+            _query_cache.move_to_end(key)
+            _query_cache_stats["hits"] += 1
+            return vec
+
+    if QUERY_CACHE_TTL > 0 and time.time() >= _redis_down_until:
+        try:
+            raw = get_redis().get(f"embed_cache:{EMBED_MODEL}:{key}")
+        except Exception as e:
+            print(f"Embedding cache lookup failed: {e}")
+            raw = None
+        if raw is not None:
+            vec = np.frombuffer(raw, dtype="<f4")
+            _remember_query(key, vec)
+            with _query_cache_lock:
+                _query_cache_stats["redis_hits"] += 1
+            return vec
+    return None
+
+
+def _store_query(key: str, vec: np.ndarray) -> np.ndarray:
+    vec = np.asarray(vec, dtype=np.float32)
+    vec.setflags(write=False)
+    _remember_query(key, vec)
+    with _query_cache_lock:
+        _query_cache_stats["misses"] += 1
+    if QUERY_CACHE_TTL > 0 and time.time() >= _redis_down_until:
+        try:
+            get_redis().set(f"embed_cache:{EMBED_MODEL}:{key}", vec.astype("<f4").tobytes(), ex=QUERY_CACHE_TTL)
+        except Exception as e:
+            print(f"Embedding cache store failed: {e}")
+    return vec
+
+
+def embed_query(text: str) -> np.ndarray:
+    """Encode a query, reusing cached embeddings keyed by the SHA-256 of the normalized text"""
+    key = content_hash(text)
+    vec = _cached_query(key)
+    if vec is None:
+        vec = _store_query(key, encode(text))
+    return vec
+
+
+async def embed_query_async(text: str) -> np.ndarray:
+    """embed_query for async handlers: misses are micro-batched with concurrent requests"""
+    key = content_hash(text)
+    vec = await asyncio.to_thread(_cached_query, key)
+    if vec is None:
+        vec = await encode_async(text)
+        vec = await asyncio.to_thread(_store_query, key, vec)
+    return vec
+
+
+def embedding_cache_stats() -> Dict[str, Any]:
+    """Hit/miss counters for the query embedding cache"""
+    with _query_cache_lock:
+        stats = dict(_query_cache_stats)
+        stats["size"] = len(_query_cache)
+    lookups = stats["hits"] + stats["redis_hits"] + stats["misses"]
+    stats["hit_rate"] = (stats["hits"] + stats["redis_hits"]) / lookups if lookups else 0.0
+    return stats
+
+
+def _index_name(list_key: str) -> str:
+    return f"{list_key}:idx"
+
+
+def _doc_prefix(list_key: str) -> str:
+    return f"{list_key}:doc:"
+
+
+def _chunk_index_name(list_key: str) -> str:
+    return f"{list_key}:chunk_idx"
+
+
+def _chunk_prefix(list_key: str) -> str:
+    return f"{list_key}:chunk:"
+
+
+def _chunk_key(list_key: str, doc_id: str, i: int) -> str:
+    return f"{_chunk_prefix(list_key)}{doc_id}:{i}"
+
+
+def encode_embedding(embedding, dtype: str = STORAGE_DTYPE) -> Dict[str, Any]:
+    """Pack an embedding into hash fields: raw little-endian bytes plus dtype (and scale for int8)"""
+    vec = np.asarray(embedding, dtype=np.float32)
+    if dtype == "int8":
+        # Symmetric per-vector quantization; cosine similarity ignores the scale
+        scale = float(np.abs(vec).max()) / 127.0 or 1.0
+        quantized = np.clip(np.round(vec / scale), -127, 127).astype(np.int8)
+        return {"embedding": quantized.tobytes(), "dtype": "int8", "scale": scale}
+    return {"embedding": vec.astype(_NUMPY_DTYPES[dtype]).tobytes(), "dtype": dtype}
+
+
+def decode_embedding(raw: bytes, dtype=b"float32", scale=None) -> np.ndarray:
+    """Inverse of encode_embedding; always returns a float32 vector"""
+    dtype = dtype.decode('utf-8') if isinstance(dtype, bytes) else (dtype or "float32")
+    vec = np.frombuffer(raw, dtype=_NUMPY_DTYPES[dtype]).astype(np.float32)
+    if dtype == "int8" and scale is not None:
+        vec *= float(scale)
+    return vec
+
+
+def read_list_entry(raw: bytes) -> Dict[str, Any]:
+    """Decode one list entry: a doc hash key, or a legacy JSON document with a float list embedding"""
+    if raw[:1] == b"{":
+        doc = json.loads(raw.decode('utf-8'))
+        return {
+            "key": None,
+            "id": doc['id'],
+            "content": doc['content'],
+            "metadata": doc['metadata'],
+            "embedding": np.asarray(doc['embedding'], dtype=np.float32),
+        }
+    return {"key": raw}
+
+
+def _create_vector_index(r: Redis, name: str, prefix: str, extra_schema: List[Any]) -> None:
+    algo_args = ["TYPE", _INDEX_TYPES[STORAGE_DTYPE], "DIM", EMBED_DIM, "DISTANCE_METRIC", "COSINE"]
+    if VECTOR_ALGORITHM == "HNSW":
+        algo_args += ["M", HNSW_M, "EF_CONSTRUCTION", HNSW_EF_CONSTRUCTION]
+    tag_args = []
+    for field in FILTER_FIELDS:
+        tag_args += [f"tag_{field}", "TAG", "SEPARATOR", _TAG_SEPARATOR]
+    r.execute_command(
+        "FT.CREATE", name, "ON", "HASH", "PREFIX", 1, prefix,
+        "SCHEMA", "embedding", "VECTOR", VECTOR_ALGORITHM, len(algo_args), *algo_args,
+        *tag_args, *extra_schema,
+    )
+    print(f"✓ Created {VECTOR_ALGORITHM} vector index {name}")
+
+
+def _index_info(r: Redis, name: str) -> Dict[str, Any]:
+    """FT.INFO as a dict with str keys (RESP2 replies are flat lists)"""
+    reply = r.execute_command("FT.INFO", name)
+    if not isinstance(reply, dict):
+        reply = dict(zip(reply[::2], reply[1::2]))
+    return {(k.decode('utf-8') if isinstance(k, bytes) else k): v for k, v in reply.items()}
+
+
+def _tag_separators(info: Dict[str, Any]) -> Dict[str, str]:
+    """SEPARATOR of each TAG attribute listed by FT.INFO"""
+    separators = {}
+    for attribute in info.get("attributes", []):
+        if not isinstance(attribute, dict):
+            attribute = dict(zip(attribute[::2], attribute[1::2]))
+        attribute = {(k.decode('utf-8') if isinstance(k, bytes) else k).lower():
+                     (v.decode('utf-8') if isinstance(v, bytes) else v) for k, v in attribute.items()}
+        if str(attribute.get("type", "")).upper() == "TAG":
+            separators[attribute.get("attribute") or attribute.get("identifier")] = attribute.get("separator", ",")
+    return separators
+
+
+def _ensure_index(r: Redis, name: str, prefix: str, extra_schema: List[Any]) -> bool:
+    """Make sure one index exists; returns True if it had to be created"""
+    try:
+        info = _index_info(r, name)
+    except ResponseError as e:
+        if "unknown command" in str(e).lower():
+            raise
+        _create_vector_index(r, name, prefix, extra_schema)
+        return True
+    if any(sep != _TAG_SEPARATOR for sep in _tag_separators(info).values()):
+        # Built with the default "," separator, which splits values such as "co., ltd".
+        # The separator cannot be altered; dropping the index keeps the hashes.
+        print(f"Rebuilding index {name} with TAG separator {_TAG_SEPARATOR!r}")
+        r.execute_command("FT.DROPINDEX", name)
+        _create_vector_index(r, name, prefix, extra_schema)
+        return True
+    # Indexes created before a field was configured lack it; RediSearch rescans on ALTER
+    added = [[f"tag_{field}", "TAG", "SEPARATOR", _TAG_SEPARATOR] for field in FILTER_FIELDS]
+    if extra_schema:
+        added.append(extra_schema)
+    for field_args in added:
+        try:
+            r.execute_command("FT.ALTER", name, "SCHEMA", "ADD", *field_args)
+        except ResponseError:
+            pass  # already in the schema
+    return False
+
+
+def ensure_vector_index(list_key: str) -> bool:
+    """Create the RediSearch vector index for a collection if the server supports it.
 
+    Returns True when KNN queries can be served by the index, False when the
+    caller should fall back to scanning the list. With chunking enabled a
+    second index covers the per-chunk hashes.
+    """
+    if SEARCH_MODE == "scan":
+        return False
+    if list_key in _index_ready:
+        return _index_ready[list_key]
 
-def upsert_invoice(doc_id: str, content: str, metadata: Dict[str, Any], embedding=None) -> None:
-    """Store invoice in Redis as JSON with embedding"""
     r = get_redis()
-    embedder = get_embedder()
-    if embedding is None:
-        embedding = embedder.encode([content])[0]
-    
-    doc_data = {
-        "id": doc_id,
-        "content": content,
-        "metadata": metadata,
-        "embedding": embedding.tolist() if isinstance(embedding, np.ndarray) else embedding
-    }
-    
-    # Store as JSON string
-    r.lpush(INVOICE_LIST_KEY, json.dumps(doc_data))
-    print(f"✓ Stored invoice {doc_id} in Redis")
+    try:
+        # content is full-text indexed for the hybrid BM25 ranking
+        created = _ensure_index(r, _index_name(list_key), _doc_prefix(list_key), ["content", "TEXT", "NOSTEM"])
+        chunk_created = CHUNK_MODE != "off" and _ensure_index(
+            r, _chunk_index_name(list_key), _chunk_prefix(list_key), ["doc_id", "TAG", "SEPARATOR", _TAG_SEPARATOR])
+        _index_ready[list_key] = True
+        if created:
+            # Legacy list entries are not keyed hashes the index can pick up
+            migrate_legacy_list(list_key)
+        if chunk_created:
+            _backfill_chunk_zero(list_key)
+    except ResponseError as e:
+        if "unknown command" not in str(e).lower() or SEARCH_MODE == "index":
+            raise
+        # Plain Redis without the search module
+        print(f"RediSearch not available, using list scan for {list_key}")
+        _index_ready[list_key] = False
+    return _index_ready[list_key]
+
+
+def _index_status(r: Redis, name: str) -> Tuple[int, float]:
+    """(indexing flag, fraction indexed) of one index from FT.INFO"""
+    info = _index_info(r, name)
+    return int(info.get("indexing", 0)), float(info.get("percent_indexed", 1))
+
+
+def wait_for_index(list_key: str, timeout: float = 600.0, poll: float = 0.5) -> bool:
+    """Block until the namespace's indexes have finished their background scan.
+
+    FT.CREATE over existing hashes indexes them asynchronously, and KNN only
+    sees part of the corpus until it is done. Returns False on timeout.
+    Namespaces served by the list scan are always ready.
+    """
+    if not ensure_vector_index(list_key):
+        return True
+    r = get_redis()
+    names = [_index_name(list_key)]
+    if CHUNK_MODE != "off":
+        names.append(_chunk_index_name(list_key))
+    deadline = time.time() + timeout
+    for name in names:
+        while True:
+            indexing, percent = _index_status(r, name)
+            if not indexing and percent >= 1.0:
+                break
+            if time.time() > deadline:
+                return False
+            time.sleep(poll)
+    return True
+
+
+def _backfill_chunk_zero(list_key: str, page_size: int = 500) -> int:
+    """Give documents stored without chunks a chunk 0 holding the document vector.
+
+    KNN in chunk mode only queries the chunk index; like CorpusMatrix, a
+    document written before chunking was enabled counts as a single chunk.
+    """
+    r = get_redis()
+    tag_fields = [f"tag_{field}" for field in FILTER_FIELDS]
+    ids = [doc_id.decode('utf-8') for doc_id in r.zrange(_ids_key(list_key), 0, -1)]
+    filled = 0
+    for start in range(0, len(ids), page_size):
+        page = ids[start:start + page_size]
+        pipe = r.pipeline(transaction=False)
+        for doc_id in page:
+            pipe.hmget(_doc_prefix(list_key) + doc_id, "chunk_count", "embedding", "dtype", "scale", *tag_fields)
+        stored = pipe.execute()
+
+        pipe = r.pipeline(transaction=True)
+        for doc_id, (chunk_count, raw_vec, dtype, scale, *tags) in zip(page, stored):
+            if raw_vec is None or int(chunk_count or 0) > 0:
+                continue
+            pipe.hset(_chunk_key(list_key, doc_id, 0), mapping={
+                "doc_id": doc_id,
+                **{field: value for field, value in zip(tag_fields, tags) if value is not None},
+                **encode_embedding(decode_embedding(raw_vec, dtype, scale)),
+            })
+            pipe.hset(_doc_prefix(list_key) + doc_id, "chunk_count", 1)
+            filled += 1
+        pipe.execute()
+    if filled:
+        print(f"✓ Added chunk 0 for {filled} unchunked documents in {list_key}")
+    return filled
+
+
+def _ids_key(list_key: str) -> str:
+    return f"{list_key}:ids"
+
+
+def _hashes_key(list_key: str) -> str:
+    return f"{list_key}:content_hashes"
+
+
+def _seq_key(list_key: str) -> str:
+    return f"{list_key}:seq"
+
+
+# Sequence numbers are taken and written to {ns}:ids in one step, inside the
+# write transaction: readers page through ids with a strict "> last_seq"
+# cursor, so a seq must never become visible after a higher one.
+_ZADD_SEQ_SCRIPT = """
+local seq = redis.call('INCRBY', KEYS[1], #ARGV) - #ARGV
+for i, id in ipairs(ARGV) do
+    redis.call('ZADD', KEYS[2], seq + i, id)
+end
+return seq + #ARGV
+"""
+
+
+def _queue_zadd_seq(pipe, list_key: str, doc_ids: List[str]) -> None:
+    if doc_ids:
+        pipe.eval(_ZADD_SEQ_SCRIPT, 2, _seq_key(list_key), _ids_key(list_key), *doc_ids)
+
+
+def _epoch_key(list_key: str) -> str:
+    return f"{list_key}:epoch"
+
+
+def _last_hit_key(list_key: str) -> str:
+    return f"{list_key}:last_hit"
+
+
+def _hits_key(list_key: str) -> str:
+    return f"{list_key}:hits"
+
+
+def _pinned_key(list_key: str) -> str:
+    return f"{list_key}:pinned"
+
+
+def _stats_key(list_key: str) -> str:
+    return f"{list_key}:query_stats"
+
+
+# Outside the "{namespace}:" key space so drop_namespace never removes the pointers
+def _active_key(list_key: str) -> str:
+    return f"{list_key}@active"
+
+
+def _previous_key(list_key: str) -> str:
+    return f"{list_key}@previous"
+
+
+def _meta_key(namespace: str) -> str:
+    return f"{namespace}:meta"
+
+
+def _namespace_info(list_key: str) -> Tuple[str, Optional[str]]:
+    """(namespace, embedding model it was written with) that this process should use.
+
+    A collection's keys normally live under list_key itself. A re-embedding
+    job (reembed_redis.py) writes a shadow namespace and then points
+    {list_key}@active at it, keeping the old one as {list_key}@previous.
+    Processes still running the old EMBED_MODEL keep using the previous
+    namespace until they are restarted with the new model.
+    """
+    cached = _namespace_cache.get(list_key)
+    if cached is not None and time.time() - cached[0] < NAMESPACE_CACHE_SECONDS:
+        return cached[1], cached[2]
+
+    r = get_redis()
+    active, previous = r.mget(_active_key(list_key), _previous_key(list_key))
+    namespace = active.decode('utf-8') if active else list_key
+    pipe = r.pipeline(transaction=False)
+    pipe.hget(_meta_key(namespace), "model")
+    if previous:
+        pipe.hget(_meta_key(previous.decode('utf-8')), "model")
+    models = [m.decode('utf-8') if m else None for m in pipe.execute()]
+    model = models[0]
+    if previous and model not in (None, EMBED_MODEL) and models[1] == EMBED_MODEL:
+        namespace, model = previous.decode('utf-8'), models[1]
+
+    _namespace_cache[list_key] = (time.time(), namespace, model)
+    return namespace, model
+
+
+def resolve_namespace(list_key: str) -> str:
+    """Key prefix currently holding a collection (list_key unless it was re-embedded)"""
+    return _namespace_info(list_key)[0]
 
 
-def upsert_do(doc_id: str, content: str, metadata: Dict[str, Any], embedding=None) -> None:
-    """Store DO in Redis as JSON with embedding"""
+def _check_model(list_key: str) -> str:
+    """Resolve the namespace for a write, refusing to mix vectors from different models"""
+    namespace, model = _namespace_info(list_key)
+    if model is not None and model != EMBED_MODEL:
+        raise ValueError(f"{namespace} holds {model} embeddings but EMBED_MODEL is {EMBED_MODEL}; "
+                         f"run reembed_redis.py to switch models")
+    return namespace
+
+
+def swap_namespace(list_key: str, namespace: str) -> Optional[str]:
+    """Atomically make namespace the active one for list_key; returns the one it replaced"""
     r = get_redis()
-    embedder = get_embedder()
-    if embedding is None:
-        embedding = embedder.encode([content])[0]
-    
-    doc_data = {
-        "id": doc_id,
-        "content": content,
-        "metadata": metadata,
-        "embedding": embedding.tolist() if isinstance(embedding, np.ndarray) else embedding
+    current = r.get(_active_key(list_key))
+    current = current.decode('utf-8') if current else list_key
+    pipe = r.pipeline(transaction=True)
+    pipe.set(_active_key(list_key), namespace)
+    pipe.set(_previous_key(list_key), current)
+    pipe.execute()
+    _namespace_cache.pop(list_key, None)
+    return current
+
+
+def drop_namespace(namespace: str) -> int:
+    """Delete every key (and RediSearch index) of a retired namespace; returns keys removed"""
+    r = get_redis()
+    for index in (_index_name(namespace), _chunk_index_name(namespace)):
+        try:
+            r.execute_command("FT.DROPINDEX", index)
+        except ResponseError:
+            pass  # no such index / no search module
+    _index_ready.pop(namespace, None)
+    _corpora.pop(namespace, None)
+    _lexical.pop(namespace, None)
+
+    removed = 0
+    batch = []
+    for key in r.scan_iter(match=f"{namespace}:*", count=1000):
+        batch.append(key)
+        if len(batch) >= 1000:
+            removed += r.delete(*batch)
+            batch = []
+    if batch:
+        removed += r.delete(*batch)
+    return removed
+
+
+def _tag_key(list_key: str, field: str, value: str) -> str:
+    return f"{list_key}:tag:{field}:{value}"
+
+
+# RediSearch splits TAG values on this; _tag_value removes it so a value is always one tag
+_TAG_SEPARATOR = "|"
+
+
+def _tag_value(value: Any) -> str:
+    return " ".join(str(value).replace(_TAG_SEPARATOR, " ").lower().split())
+
+
+def _doc_tags(metadata: Dict[str, Any]) -> Dict[str, str]:
+    """Normalized values of the filterable metadata fields present on a document"""
+    if not isinstance(metadata, dict):
+        return {}
+    return {
+        field: _tag_value(metadata[field])
+        for field in FILTER_FIELDS
+        if metadata.get(field) not in (None, "")
     }
-    
-    # Store as JSON string
-    r.lpush(DO_LIST_KEY, json.dumps(doc_data))
-    print(f"✓ Stored DO {doc_id} in Redis")
 
 
-def comparison_invoice(query_text: str, k: int = 3) -> Dict[str, Any]:
-    """Find most similar invoices using cosine similarity"""
+def filter_candidates(list_key: str, filters: Optional[Dict[str, Any]]) -> Optional[Set[str]]:
+    """Ids matching every filter (a value or list of values per field); None means no filtering"""
+    if not filters:
+        return None
+    fields = {}
+    for field, values in filters.items():
+        if field not in FILTER_FIELDS:
+            print(f"Ignoring filter on {field}: not one of {FILTER_FIELDS}")
+            continue
+        if not isinstance(values, (list, tuple, set)):
+            values = [values]
+        fields[field] = [_tag_value(v) for v in values]
+    if not fields:
+        return None
+
+    # OR within a field, AND across fields
+    pipe = get_redis().pipeline(transaction=False)
+    for field, values in fields.items():
+        pipe.sunion([_tag_key(list_key, field, v) for v in values])
+    candidates = None
+    for members in pipe.execute():
+        ids = {m.decode('utf-8') for m in members}
+        candidates = ids if candidates is None else candidates & ids
+    return candidates
+
+
+_PAGE_BREAK = re.compile(r"\f|\n*--- Page \d+ ---\n")
+
+
+def chunk_text(content: Union[str, List[str]], mode: str = CHUNK_MODE,
+               max_tokens: int = CHUNK_MAX_TOKENS) -> List[str]:
+    """Split content into token-bounded windows of whole pages or paragraphs.
+
+    content is OCR text (pages separated by form feeds or the "--- Page N ---"
+    markers of tessaract_ocr, paragraphs by blank lines as in the
+    run_rapid4 paragraphs file) or a ready list of paragraphs from
+    src.layout.words_to_paragraphs. Consecutive units are packed while they fit
+    in max_tokens; a unit longer than that is cut into word windows.
+    """
+    if isinstance(content, list):
+        units = [u.strip() for u in content if u and u.strip()]
+    elif mode == "page":
+        units = [u.strip() for u in _PAGE_BREAK.split(content) if u.strip()]
+    else:
+        units = [u.strip() for u in re.split(r"\n\s*\n", content) if u.strip()]
+    if not units:
+        return []
+
+    pieces, piece_tokens = [], []
+    for unit, n in zip(units, count_tokens(units)):
+        if n <= max_tokens:
+            pieces.append(unit)
+            piece_tokens.append(n)
+            continue
+        words = unit.split()
+        # Assume uniform token density across the unit's words
+        per_window = max(1, int(len(words) * max_tokens / n))
+        for i in range(0, len(words), per_window):
+            window = words[i:i + per_window]
+            pieces.append(" ".join(window))
+            piece_tokens.append(math.ceil(n * len(window) / len(words)))
+
+    chunks, current, current_tokens = [], [], 0
+    for piece, n in zip(pieces, piece_tokens):
+        if current and current_tokens + n > max_tokens:
+            chunks.append("\n\n".join(current))
+            current, current_tokens = [], 0
+        current.append(piece)
+        current_tokens += n
+    if current:
+        chunks.append("\n\n".join(current))
+    # Bound the encode cost of very long documents
+    return chunks[:CHUNK_MAX_CHUNKS]
+
+
+def _prepare_embeddings(docs: List[Dict[str, Any]], batch_size: Optional[int] = None) -> None:
+    """Fill in missing document embeddings (and chunk embeddings when chunking is on)"""
+    if CHUNK_MODE != "off":
+        pending = [doc for doc in docs if doc.get("chunk_embeddings") is None]
+        chunk_lists = [chunk_text(doc["content"]) or [doc["content"]] for doc in pending]
+        flat = [chunk for chunks in chunk_lists for chunk in chunks]
+        vectors = encode_many(flat, batch_size=batch_size) if flat else []
+        start = 0
+        for doc, chunks in zip(pending, chunk_lists):
+            doc["chunk_embeddings"] = vectors[start:start + len(chunks)]
+            start += len(chunks)
+        for doc in docs:
+            if doc.get("embedding") is None:
+                # Whole-document vector is the normalized mean of its chunks
+                rows = np.asarray(doc["chunk_embeddings"], dtype=np.float32)
+                rows = rows / np.maximum(np.linalg.norm(rows, axis=1, keepdims=True), 1e-12)
+                doc["embedding"] = rows.mean(axis=0)
+        return
+
+    missing = [doc for doc in docs if doc.get("embedding") is None]
+    if missing:
+        vectors = encode_many([doc["content"] for doc in missing], batch_size=batch_size)
+        for doc, vec in zip(missing, vectors):
+            doc["embedding"] = vec
+
+
+def content_hash(content: str) -> str:
+    """SHA-256 of case- and whitespace-normalized content, used to spot re-uploads"""
+    normalized = " ".join(content.lower().split())
+    return hashlib.sha256(normalized.encode('utf-8')).hexdigest()
+
+
+def _store_batch(list_key: str, docs: List[Dict[str, Any]]) -> List[str]:
+    """Upsert documents keyed on id in two round trips; returns the id holding each content.
+
+    Each record is a hash (binary embedding, separate content/metadata fields),
+    its id is kept in a sorted set ordered by write sequence, and a content hash
+    map makes re-uploads of the same text under a new id a no-op.
+    """
+    if not docs:
+        return []
+    r = get_redis()
+    digests = [content_hash(doc["content"]) for doc in docs]
+
+    pipe = r.pipeline(transaction=False)
+    _queue_claims(pipe, list_key, docs, digests)
+    replies = pipe.execute()
+
+    pipe = r.pipeline(transaction=True)
+    stored_ids = _queue_writes(pipe, list_key, docs, digests, replies)
+    pipe.execute()
+    return stored_ids
+
+
+def _queue_claims(pipe, list_key: str, docs: List[Dict[str, Any]], digests: List[str]) -> None:
+    """First round trip of a batch upsert (works on sync and asyncio pipelines)"""
+    # Atomically claim each content hash, then read back who owns it
+    for doc, digest in zip(docs, digests):
+        pipe.hsetnx(_hashes_key(list_key), digest, doc["id"])
+        pipe.hget(_hashes_key(list_key), digest)
+        pipe.hmget(_doc_prefix(list_key) + doc["id"], "content_hash", "metadata", "chunk_count")
+
+
+def _queue_writes(pipe, list_key: str, docs: List[Dict[str, Any]], digests: List[str],
+                  replies: List[Any]) -> List[str]:
+    """Second round trip: queue the writes given the claim replies; returns the owner ids"""
+    now = time.time()
+    stored_ids = []
+    for i, (doc, digest) in enumerate(zip(docs, digests)):
+        owner = replies[3 * i + 1].decode('utf-8')
+        previous, old_metadata, old_chunk_count = replies[3 * i + 2]
+        stored_ids.append(owner)
+        if owner != doc["id"]:
+            print(f"Skipping {doc['id']}: same content as {owner}")
+            continue
+        key = _doc_prefix(list_key) + doc["id"]
+        if previous is not None and previous.decode('utf-8') != digest:
+            # Content changed, release the old hash so it can be claimed again
+            pipe.hdel(_hashes_key(list_key), previous)
+
+        # Keep the tag sets in step with the metadata being replaced
+        tags = _doc_tags(doc["metadata"])
+        old_tags = _doc_tags(json.loads(old_metadata)) if old_metadata else {}
+        for field, value in old_tags.items():
+            if tags.get(field) != value:
+                pipe.srem(_tag_key(list_key, field, value), doc["id"])
+                if field not in tags:
+                    pipe.hdel(key, f"tag_{field}")
+        for field, value in tags.items():
+            pipe.sadd(_tag_key(list_key, field, value), doc["id"])
+
+        # One hash per chunk (with the doc's tags) so the chunk index can filter too
+        chunk_embeddings = doc.get("chunk_embeddings")
+        chunk_count = len(chunk_embeddings) if chunk_embeddings is not None else 0
+        for j in range(chunk_count):
+            pipe.hset(_chunk_key(list_key, doc["id"], j), mapping={
+                "doc_id": doc["id"],
+                **{f"tag_{field}": value for field, value in tags.items()},
+                **encode_embedding(chunk_embeddings[j]),
+            })
+        for j in range(chunk_count, int(old_chunk_count or 0)):
+            pipe.delete(_chunk_key(list_key, doc["id"], j))
+
+        pipe.hset(key, mapping={
+            "id": doc["id"],
+            "content": doc["content"],
+            "metadata": json.dumps(doc["metadata"]),
+            "content_hash": digest,
+            "chunk_count": chunk_count,
+            "model": EMBED_MODEL,
+            "dim": len(doc["embedding"]),
+            **{f"tag_{field}": value for field, value in tags.items()},
+            **encode_embedding(doc["embedding"]),
+        })
+        # A fresh write counts as a use for LRU eviction and TTL
+        pipe.zadd(_last_hit_key(list_key), {doc["id"]: now})
+    _queue_zadd_seq(pipe, list_key, [doc["id"] for owner, doc in zip(stored_ids, docs) if owner == doc["id"]])
+    if any(owner == doc["id"] for owner, doc in zip(stored_ids, docs)):
+        pipe.hsetnx(_meta_key(list_key), "model", EMBED_MODEL)
+        pipe.hsetnx(_meta_key(list_key), "dim", EMBED_DIM)
+    return stored_ids
+
+
+def _store_document(list_key: str, doc_id: str, content: str, metadata: Dict[str, Any], embedding=None) -> str:
+    """Upsert one document keyed on doc_id; returns the id that holds the content"""
+    list_key = _check_model(list_key)
+    doc = {"id": doc_id, "content": content, "metadata": metadata, "embedding": embedding}
+    _prepare_embeddings([doc])
+    stored_id = _store_batch(list_key, [doc])[0]
+    enforce_retention(list_key)
+    return stored_id
+
+
+async def _store_document_async(list_key: str, doc_id: str, content: str, metadata: Dict[str, Any],
+                                embedding=None) -> str:
+    """_store_document on the asyncio client; encoding runs in a worker thread"""
+    list_key = await asyncio.to_thread(_check_model, list_key)
+    doc = {"id": doc_id, "content": content, "metadata": metadata, "embedding": embedding}
+    if embedding is None or CHUNK_MODE != "off":
+        await asyncio.to_thread(_prepare_embeddings, [doc])
+    digests = [content_hash(content)]
+
+    r = get_async_redis()
+    pipe = r.pipeline(transaction=False)
+    _queue_claims(pipe, list_key, [doc], digests)
+    replies = await pipe.execute()
+
+    pipe = r.pipeline(transaction=True)
+    stored_ids = _queue_writes(pipe, list_key, [doc], digests, replies)
+    await pipe.execute()
+    if MAX_DOCS > 0 or DOC_TTL > 0:
+        await asyncio.to_thread(enforce_retention, list_key)
+    return stored_ids[0]
+
+
+def _delete_documents(list_key: str, doc_ids: List[str]) -> int:
+    """Remove documents, their content hashes, chunks and tags; returns how many existed.
+
+    All of them go in one transaction with a single epoch bump.
+    """
+    if not doc_ids:
+        return 0
+    r = get_redis()
+    pipe = r.pipeline(transaction=False)
+    for doc_id in doc_ids:
+        pipe.hmget(_doc_prefix(list_key) + doc_id, "content_hash", "metadata", "chunk_count")
+    stored = pipe.execute()
+
+    pipe = r.pipeline(transaction=True)
+    for doc_id, (digest, metadata, chunk_count) in zip(doc_ids, stored):
+        pipe.delete(_doc_prefix(list_key) + doc_id)
+        for j in range(int(chunk_count or 0)):
+            pipe.delete(_chunk_key(list_key, doc_id, j))
+        if digest is not None:
+            pipe.hdel(_hashes_key(list_key), digest)
+        for field, value in (_doc_tags(json.loads(metadata)) if metadata else {}).items():
+            pipe.srem(_tag_key(list_key, field, value), doc_id)
+    pipe.zrem(_ids_key(list_key), *doc_ids)
+    pipe.zrem(_last_hit_key(list_key), *doc_ids)
+    pipe.hdel(_hits_key(list_key), *doc_ids)
+    pipe.srem(_pinned_key(list_key), *doc_ids)
+    # In-process matrices cannot drop rows incrementally, make them reload
+    pipe.incr(_epoch_key(list_key))
+    pipe.execute()
+    return sum(1 for digest, metadata, _ in stored if metadata is not None or digest is not None)
+
+
+def _delete_document(list_key: str, doc_id: str) -> bool:
+    """Remove one document; returns False if it did not exist"""
+    return _delete_documents(resolve_namespace(list_key), [doc_id]) > 0
+
+
+def _queue_hits(pipe, list_key: str, doc_ids: List[str]) -> None:
+    now = time.time()
+    pipe.zadd(_last_hit_key(list_key), {doc_id: now for doc_id in doc_ids}, xx=True)
+    for doc_id in doc_ids:
+        pipe.hincrby(_hits_key(list_key), doc_id, 1)
+
+
+def _queue_query_record(pipe, list_key: str, results: Dict[str, Any], stats: Dict[str, Any]) -> bool:
+    """Queue hit counters and the telemetry entry of one search; False if nothing to send"""
+    doc_ids = results.get("ids", [[]])[0]
+    queued = False
+    if doc_ids and (MAX_DOCS > 0 or DOC_TTL > 0):
+        _queue_hits(pipe, list_key, doc_ids)
+        queued = True
+    if QUERY_STATS:
+        scores = results.get("scores", [[]])[0]
+        pipe.xadd(_stats_key(list_key), {
+            "top1": f"{scores[0]:.4f}" if scores else "",
+            "returned": len(doc_ids),
+            **{field: value for field, value in stats.items() if value is not None},
+        }, maxlen=QUERY_STATS_MAXLEN, approximate=True)
+        queued = True
+    return queued
+
+
+def _record_query(list_key: str, results: Dict[str, Any], stats: Dict[str, Any]) -> None:
     try:
+        pipe = get_redis().pipeline(transaction=False)
+        if _queue_query_record(pipe, list_key, results, stats):
+            pipe.execute()
+    except Exception as e:
+        print(f"Recording query stats for {list_key} failed: {e}")
+
+
+def set_pinned(list_key: str, doc_id: str, pinned: bool = True) -> None:
+    """Pin (or unpin) a golden exemplar so retention never evicts it"""
+    list_key = resolve_namespace(list_key)
+    if pinned:
+        get_redis().sadd(_pinned_key(list_key), doc_id)
+    else:
+        get_redis().srem(_pinned_key(list_key), doc_id)
+
+
+def enforce_retention(list_key: str) -> int:
+    """Apply RAG_DOC_TTL and RAG_MAX_DOCS to a collection; returns how many docs were evicted"""
+    if MAX_DOCS <= 0 and DOC_TTL <= 0:
+        return 0
+    list_key = resolve_namespace(list_key)
+    r = get_redis()
+    pipe = r.pipeline(transaction=False)
+    pipe.zcard(_ids_key(list_key))
+    pipe.zcard(_last_hit_key(list_key))
+    pipe.smembers(_pinned_key(list_key))
+    total, tracked, pinned = pipe.execute()
+    if tracked < total:
+        # Documents stored before retention existed: oldest possible last use
+        r.zunionstore(_last_hit_key(list_key), {_last_hit_key(list_key): 1, _ids_key(list_key): 0},
+                      aggregate="MAX")
+    pinned = {p.decode('utf-8') for p in pinned}
+
+    evict: List[str] = []
+    if DOC_TTL > 0:
+        expired = r.zrangebyscore(_last_hit_key(list_key), "-inf", time.time() - DOC_TTL)
+        evict = [doc_id for doc_id in (e.decode('utf-8') for e in expired) if doc_id not in pinned]
+    if MAX_DOCS > 0 and total - len(evict) > MAX_DOCS:
+        target = total - len(evict) - int(MAX_DOCS * (1.0 - EVICT_SLACK))
+        chosen = set(evict)
+        # Least recently retrieved first, skipping pinned documents
+        for start in range(0, total, 500):
+            page = r.zrange(_last_hit_key(list_key), start, start + 499)
+            if not page:
+                break
+            for doc_id in (p.decode('utf-8') for p in page):
+                if doc_id in pinned or doc_id in chosen:
+                    continue
+                evict.append(doc_id)
+                chosen.add(doc_id)
+                target -= 1
+                if target <= 0:
+                    break
+            if target <= 0:
+                break
+
+    evicted = _delete_documents(list_key, evict)
+    if evicted:
+        print(f"✓ Evicted {evicted} docs from {list_key} (cap {MAX_DOCS or '-'}, ttl {DOC_TTL or '-'}s)")
+    return evicted
+
+
+def upsert_invoice(doc_id: str, content: str, metadata: Dict[str, Any], embedding=None) -> str:
+    """Insert or replace an invoice in Redis, keyed on doc_id"""
+    stored_id = _store_document(INVOICE_LIST_KEY, doc_id, content, metadata, embedding)
+    if stored_id == doc_id:
+        print(f"✓ Stored invoice {doc_id} in Redis")
+    return stored_id
+
+
+def upsert_do(doc_id: str, content: str, metadata: Dict[str, Any], embedding=None) -> str:
+    """Insert or replace a DO in Redis, keyed on doc_id"""
+    stored_id = _store_document(DO_LIST_KEY, doc_id, content, metadata, embedding)
+    if stored_id == doc_id:
+        print(f"✓ Stored DO {doc_id} in Redis")
+    return stored_id
+
+
+async def upsert_invoice_async(doc_id: str, content: str, metadata: Dict[str, Any], embedding=None) -> str:
+    """upsert_invoice for async handlers"""
+    stored_id = await _store_document_async(INVOICE_LIST_KEY, doc_id, content, metadata, embedding)
+    if stored_id == doc_id:
+        print(f"✓ Stored invoice {doc_id} in Redis")
+    return stored_id
+
+
+async def upsert_do_async(doc_id: str, content: str, metadata: Dict[str, Any], embedding=None) -> str:
+    """upsert_do for async handlers"""
+    stored_id = await _store_document_async(DO_LIST_KEY, doc_id, content, metadata, embedding)
+    if stored_id == doc_id:
+        print(f"✓ Stored DO {doc_id} in Redis")
+    return stored_id
+
+
+def delete_invoice(doc_id: str) -> bool:
+    """Delete an invoice by id"""
+    return _delete_document(INVOICE_LIST_KEY, doc_id)
+
+
+def delete_do(doc_id: str) -> bool:
+    """Delete a DO by id"""
+    return _delete_document(DO_LIST_KEY, doc_id)
+
+
+def bulk_upsert(records: Iterable[Dict[str, Any]], list_key: str = INVOICE_LIST_KEY,
+                batch_size: int = 64, chunk_size: int = 500) -> int:
+    """Upsert many documents: batched encoding, one pipelined transaction per chunk.
+
+    Each record is {"id", "content", "metadata", "embedding" (optional)}.
+    Missing embeddings (and chunk embeddings when RAG_CHUNK_MODE is on) are
+    encoded batch_size at a time; writes go out
+    chunk_size documents per round trip. Returns the number of documents stored.
+    """
+    list_key = _check_model(list_key)
+    t0 = time.time()
+    stored = 0
+    seen = 0
+    chunk: List[Dict[str, Any]] = []
+
+    def flush() -> int:
+        nonlocal chunk
+        # Ids must be unique within a batch; the last record for an id wins
+        chunk = list({doc["id"]: doc for doc in chunk}.values())
+        _prepare_embeddings(chunk, batch_size)
+        ids = _store_batch(list_key, chunk)
+        return sum(1 for doc, stored_id in zip(chunk, ids) if doc["id"] == stored_id)
+
+    for record in records:
+        chunk.append({
+            "id": record["id"],
+            "content": record.get("content") or "",
+            "metadata": record.get("metadata") or {},
+            "embedding": record.get("embedding"),
+        })
+        seen += 1
+        if len(chunk) >= chunk_size:
+            stored += flush()
+            chunk = []
+    if chunk:
+        stored += flush()
+    enforce_retention(list_key)
+
+    elapsed = time.time() - t0
+    rate = seen / elapsed if elapsed > 0 else 0.0
+    print(f"✓ Bulk upserted {stored}/{seen} docs into {list_key} in {elapsed:.2f}s ({rate:.1f} docs/s)")
+    return stored
+
+
+def migrate_legacy_list(list_key: str = INVOICE_LIST_KEY) -> int:
+    """Fold entries of the old LPUSH list into the keyed store, then drop the list.
+
+    Duplicate ids collapse into one record (the newest list entry wins) and
+    duplicate content is skipped by the content hash check.
+    """
+    r = get_redis()
+    raw_entries = r.lrange(list_key, 0, -1)
+    records = []
+    # Oldest first so the newest entry for an id is written last
+    for raw in reversed(raw_entries):
+        try:
+            doc = read_list_entry(raw)
+            if doc["key"] is not None:
+                fields = r.hgetall(doc["key"])
+                if not fields:
+                    continue
+                doc = {
+                    "id": fields[b"id"].decode('utf-8'),
+                    "content": fields[b"content"].decode('utf-8'),
+                    "metadata": json.loads(fields[b"metadata"]),
+                    "embedding": decode_embedding(fields[b"embedding"], fields.get(b"dtype"), fields.get(b"scale")),
+                }
+            records.append(doc)
+        except Exception as e:
+            print(f"Error migrating list entry: {e}")
+    migrated = bulk_upsert(records, list_key)
+    # Only remove what we read; anything pushed meanwhile stays for the next run
+    r.ltrim(list_key, 0, -(len(raw_entries) + 1))
+    print(f"✓ Migrated {migrated} legacy entries from {list_key}")
+    return migrated
+
+
+def _escape_tag(value: str) -> str:
+    # RediSearch TAG syntax treats punctuation and spaces as separators
+    return re.sub(r"([^\w])", r"\\\1", value)
+
+
+def _aggregate_chunk_scores(owners: np.ndarray, scores: np.ndarray, n: int) -> np.ndarray:
+    """Per-document score from its chunk scores (RAG_CHUNK_AGGREGATE); -inf for no chunks"""
+    if CHUNK_AGGREGATE == "mean":
+        sums = np.bincount(owners, weights=scores, minlength=n)
+        counts = np.bincount(owners, minlength=n)
+        return np.where(counts > 0, sums / np.maximum(counts, 1), -np.inf).astype(np.float32)
+    doc_scores = np.full(n, -np.inf, dtype=np.float32)
+    np.maximum.at(doc_scores, owners, scores)
+    return doc_scores
+
+
+def _filter_clauses(filters: Optional[Dict[str, Any]]) -> List[str]:
+    """RediSearch TAG clauses for metadata filters (OR within a field, AND across fields)"""
+    clauses = []
+    for field, values in (filters or {}).items():
+        if field not in FILTER_FIELDS:
+            print(f"Ignoring filter on {field}: not one of {FILTER_FIELDS}")
+            continue
+        if not isinstance(values, (list, tuple, set)):
+            values = [values]
+        clauses.append(f"@tag_{field}:{{{' | '.join(_escape_tag(_tag_value(v)) for v in values)}}}")
+    return clauses
+
+
+def _knn_command(list_key: str, query_embedding, k: int,
+                 filters: Optional[Dict[str, Any]] = None,
+                 include_embeddings: bool = False,
+                 doc_ids: Optional[List[str]] = None) -> List[Any]:
+    """FT.SEARCH arguments for a top-k query (over the chunk index when chunking is on).
+
+    doc_ids restricts the query to those documents (the lexical prefilter).
+    """
+    clauses = _filter_clauses(filters)
+    restrict = []
+    if CHUNK_MODE != "off":
+        index, n = _chunk_index_name(list_key), k * CHUNK_OVERSAMPLE
+        returned = ["doc_id", "score"]
+        if doc_ids is not None:
+            clauses.append(f"@doc_id:{{{' | '.join(_escape_tag(doc_id) for doc_id in doc_ids)}}}")
+    else:
+        index, n = _index_name(list_key), k
+        returned = ["content", "metadata", "score"] + (["embedding", "dtype", "scale"] if include_embeddings else [])
+        if doc_ids is not None:
+            restrict = ["INKEYS", len(doc_ids), *[_doc_prefix(list_key) + doc_id for doc_id in doc_ids]]
+    prefilter = f"({' '.join(clauses)})" if clauses else "*"
+    query = f"{prefilter}=>[KNN {n} @embedding $vec EF_RUNTIME {HNSW_EF_RUNTIME} AS score]" \
+        if VECTOR_ALGORITHM == "HNSW" else f"{prefilter}=>[KNN {n} @embedding $vec AS score]"
+    return [
+        "FT.SEARCH", index, query, *restrict,
+        "PARAMS", 2, "vec", encode_embedding(query_embedding)["embedding"],
+        "SORTBY", "score", "RETURN", len(returned), *returned,
+        "LIMIT", 0, n, "DIALECT", 2,
+    ]
+
+
+def _reply_fields(reply) -> List[Dict[str, bytes]]:
+    # Reply layout: [total, key1, [field, value, ...], key2, [...], ...]
+    return [{fields[i].decode('utf-8'): fields[i + 1] for i in range(0, len(fields), 2)}
+            for fields in reply[2::2]]
+
+
+def _parse_knn_reply(list_key: str, reply, include_embeddings: bool = False) -> Dict[str, Any]:
+    prefix = len(_doc_prefix(list_key))
+    ids = [key.decode('utf-8')[prefix:] for key in reply[1::2]]
+    documents = []
+    metadatas = []
+    scores = []
+    embeddings = []
+    for doc in _reply_fields(reply):
+        documents.append(doc['content'].decode('utf-8'))
+        metadatas.append(json.loads(doc['metadata']))
+        # COSINE distance -> similarity
+        scores.append(1.0 - float(doc['score']))
+        if include_embeddings:
+            embeddings.append(decode_embedding(doc['embedding'], doc.get('dtype', b"float32"), doc.get('scale')))
+
+    results = {
+        "ids": [ids],
+        "documents": [documents],
+        "metadatas": [metadatas],
+        "scores": [scores]
+    }
+    if include_embeddings:
+        results["embeddings"] = [embeddings]
+    return results
+
+
+def _chunk_hits(reply) -> Tuple[List[str], np.ndarray, np.ndarray]:
+    """(doc ids in hit order, owner index of each chunk hit, its similarity) from a chunk KNN reply"""
+    doc_ids: Dict[str, int] = {}
+    owners, scores = [], []
+    for chunk in _reply_fields(reply):
+        doc_id = chunk['doc_id'].decode('utf-8')
+        owners.append(doc_ids.setdefault(doc_id, len(doc_ids)))
+        # COSINE distance -> similarity
+        scores.append(1.0 - float(chunk['score']))
+    return list(doc_ids), np.asarray(owners, dtype=np.int64), np.asarray(scores, dtype=np.float32)
+
+
+def _queue_chunk_counts(pipe, list_key: str, doc_ids: List[str]) -> None:
+    for doc_id in doc_ids:
+        pipe.hget(_doc_prefix(list_key) + doc_id, "chunk_count")
+
+
+def _queue_chunk_vectors(pipe, list_key: str, doc_ids: List[str], counts) -> List[int]:
+    """Queue loads of every chunk vector of doc_ids; returns the owner index of each"""
+    owners = []
+    for i, (doc_id, count) in enumerate(zip(doc_ids, counts)):
+        for j in range(int(count or 0)):
+            pipe.hmget(_chunk_key(list_key, doc_id, j), "embedding", "dtype", "scale")
+            owners.append(i)
+    return owners
+
+
+def _score_chunk_vectors(query_embedding, owners: List[int], replies) -> Tuple[np.ndarray, np.ndarray]:
+    """Cosine similarity of each loaded chunk vector to the query, skipping missing chunks"""
+    q = np.asarray(query_embedding, dtype=np.float32)
+    q = q / max(float(np.linalg.norm(q)), 1e-12)
+    kept, scores = [], []
+    for owner, (raw_vec, dtype, scale) in zip(owners, replies):
+        if raw_vec is None:
+            continue
+        vec = decode_embedding(raw_vec, dtype, scale)
+        kept.append(owner)
+        scores.append(float(vec @ q) / max(float(np.linalg.norm(vec)), 1e-12))
+    return np.asarray(kept, dtype=np.int64), np.asarray(scores, dtype=np.float32)
+
+
+def _rank_chunk_documents(doc_ids: List[str], owners: np.ndarray, scores: np.ndarray,
+                          k: int) -> Tuple[List[str], np.ndarray]:
+    """Aggregate chunk scores per document; returns the top-k doc ids and their scores"""
+    if not doc_ids or owners.size == 0:
+        return [], np.empty(0, dtype=np.float32)
+    doc_scores = _aggregate_chunk_scores(owners, scores, len(doc_ids))
+    top = [i for i in np.argsort(-doc_scores)[:k] if np.isfinite(doc_scores[i])]
+    return [doc_ids[i] for i in top], doc_scores[top]
+
+
+def _knn_search(list_key: str, query_embedding, k: int,
+                filters: Optional[Dict[str, Any]] = None,
+                include_embeddings: bool = False,
+                doc_ids: Optional[List[str]] = None) -> Dict[str, Any]:
+    """Top-k cosine search served by the RediSearch vector index.
+
+    With chunking on, k * RAG_CHUNK_OVERSAMPLE chunks are retrieved from the
+    chunk index and aggregated per document. RAG_CHUNK_AGGREGATE=mean reloads
+    all chunks of those documents so the mean matches the scan's.
+    """
+    r = get_redis()
+    reply = r.execute_command(*_knn_command(list_key, query_embedding, k, filters, include_embeddings, doc_ids))
+    if CHUNK_MODE != "off":
+        doc_ids, owners, scores = _chunk_hits(reply)
+        if CHUNK_AGGREGATE == "mean" and doc_ids:
+            # Average over all of a candidate's chunks, as the scan does, not just the ones that hit
+            pipe = r.pipeline(transaction=False)
+            _queue_chunk_counts(pipe, list_key, doc_ids)
+            counts = pipe.execute()
+            pipe = r.pipeline(transaction=False)
+            chunk_owners = _queue_chunk_vectors(pipe, list_key, doc_ids, counts)
+            owners, scores = _score_chunk_vectors(query_embedding, chunk_owners,
+                                                  pipe.execute() if chunk_owners else [])
+        doc_ids, scores = _rank_chunk_documents(doc_ids, owners, scores, k)
+        return _load_documents(r, list_key, doc_ids, include_embeddings, scores=scores)
+    return _parse_knn_reply(list_key, reply, include_embeddings)
+
+
+async def _knn_search_async(list_key: str, query_embedding, k: int,
+                            filters: Optional[Dict[str, Any]] = None,
+                            include_embeddings: bool = False) -> Dict[str, Any]:
+    """_knn_search on the asyncio client"""
+    r = get_async_redis()
+    reply = await r.execute_command(*_knn_command(list_key, query_embedding, k, filters, include_embeddings))
+    if CHUNK_MODE != "off":
+        doc_ids, owners, scores = _chunk_hits(reply)
+        if CHUNK_AGGREGATE == "mean" and doc_ids:
+            pipe = r.pipeline(transaction=False)
+            _queue_chunk_counts(pipe, list_key, doc_ids)
+            counts = await pipe.execute()
+            pipe = r.pipeline(transaction=False)
+            chunk_owners = _queue_chunk_vectors(pipe, list_key, doc_ids, counts)
+            owners, scores = _score_chunk_vectors(query_embedding, chunk_owners,
+                                                  await pipe.execute() if chunk_owners else [])
+        doc_ids, scores = _rank_chunk_documents(doc_ids, owners, scores, k)
+        pipe = r.pipeline(transaction=False)
+        _queue_document_loads(pipe, list_key, doc_ids, include_embeddings)
+        return _parse_document_loads(doc_ids, await pipe.execute(), include_embeddings, scores=scores)
+    return _parse_knn_reply(list_key, reply, include_embeddings)
+
+
+def _queue_document_loads(pipe, list_key: str, doc_ids: List[str], fetch_vectors: bool) -> None:
+    fields = ["content", "metadata"] + (["embedding", "dtype", "scale"] if fetch_vectors else [])
+    for doc_id in doc_ids:
+        pipe.hmget(_doc_prefix(list_key) + doc_id, *fields)
+
+
+def _parse_document_loads(doc_ids: List[str], replies, include_embeddings: bool = False,
+                          vectors: Optional[np.ndarray] = None, scores=None) -> Dict[str, Any]:
+    ids = []
+    documents = []
+    metadatas = []
+    embeddings = []
+    kept_scores = []
+    for i, values in enumerate(replies):
+        if values[0] is None:
+            continue
+        ids.append(doc_ids[i])
+        if scores is not None:
+            kept_scores.append(float(scores[i]))
+        documents.append(values[0].decode('utf-8'))
+        metadatas.append(json.loads(values[1]))
+        if include_embeddings:
+            embeddings.append(vectors[i] if vectors is not None else decode_embedding(*values[2:]))
+
+    results = {
+        "ids": [ids],
+        "documents": [documents],
+        "metadatas": [metadatas]
+    }
+    if scores is not None:
+        results["scores"] = [kept_scores]
+    if include_embeddings:
+        results["embeddings"] = [embeddings]
+    return results
+
+
+def _load_documents(r: Redis, list_key: str, doc_ids: List[str], include_embeddings: bool = False,
+                    vectors: Optional[np.ndarray] = None, scores=None) -> Dict[str, Any]:
+    """Fetch content/metadata (and stored vectors) of ranked ids in one round trip.
+
+    Pass vectors when the caller already holds the rows for doc_ids, and
+    scores to report the similarity of each under "scores".
+    """
+    pipe = r.pipeline(transaction=False)
+    _queue_document_loads(pipe, list_key, doc_ids, include_embeddings and vectors is None)
+    return _parse_document_loads(doc_ids, pipe.execute(), include_embeddings, vectors, scores)
+
+
+class CorpusMatrix:
+    """In-process copy of a collection's embeddings as one contiguous float32 matrix.
+
+    Rows are L2-normalized on ingest so ranking is a single matrix-vector
+    product. Every upsert gets a new sequence number in the ids sorted set, so
+    each refresh fetches just the ids written since the last one; deletes bump
+    an epoch counter that triggers a full reload. Only vectors are held in
+    memory; content and metadata are loaded for the top-k winners.
+
+    With chunking on, chunk vectors are kept in a second matrix whose rows
+    point back at their document row; a document stored without chunks
+    counts as a single chunk.
+    """
+
+    def __init__(self, list_key: str):
+        self.list_key = list_key
+        self._lock = threading.RLock()
+        self.reset()
+
+    def reset(self) -> None:
+        with self._lock:
+            self.matrix = np.empty((0, EMBED_DIM), dtype=np.float32)
+            self.ids: List[str] = []
+            self.rows: Dict[str, int] = {}
+            self.chunk_matrix = np.empty((0, EMBED_DIM), dtype=np.float32)
+            self.chunk_owner = np.empty(0, dtype=np.int64)
+            self.last_seq = 0
+            self.epoch = None
+
+    def refresh(self) -> int:
+        """Pull documents written since the last refresh; returns how many rows changed"""
         r = get_redis()
-        embedder = get_embedder()
-        
-        # Get query embedding
-        query_embedding = embedder.encode([query_text])[0]
-        
-        # Get all invoices from Redis
-        all_docs = r.lrange(INVOICE_LIST_KEY, 0, -1)
-        
-        if not all_docs:
-            print(f"No documents found in Redis for key: {INVOICE_LIST_KEY}")
-            return {"documents": [[]], "metadatas": [[]]}
-        
-        similarities = []
-        for doc_bytes in all_docs:
-            try:
-                doc = json.loads(doc_bytes.decode('utf-8'))
-                doc_embedding = np.array(doc['embedding'])
-                similarity = 1 - cosine(query_embedding, doc_embedding)
-                similarities.append({
-                    'content': doc['content'],
-                    'metadata': doc['metadata'],
-                    'similarity': similarity
-                })
-            except Exception as e:
-                print(f"Error processing doc: {e}")
+        with self._lock:
+            pipe = r.pipeline(transaction=True)
+            pipe.get(_epoch_key(self.list_key))
+            pipe.exists(self.list_key)
+            pipe.zrangebyscore(_ids_key(self.list_key), f"({self.last_seq}", "+inf", withscores=True)
+            epoch, has_legacy, changed = pipe.execute()
+
+            if has_legacy:
+                # Old LPUSH-list data, upgrade it once and re-read
+                migrate_legacy_list(self.list_key)
+                return self.refresh()
+            if epoch != self.epoch:
+                if self.epoch is not None or self.last_seq:
+                    self.reset()
+                    return self.refresh()
+                self.epoch = epoch
+            if not changed:
+                return 0
+
+            # Only vectors are fetched here; content stays in Redis until it wins
+            pipe = r.pipeline(transaction=False)
+            for doc_id, _ in changed:
+                pipe.hmget(_doc_prefix(self.list_key) + doc_id.decode('utf-8'),
+                           "embedding", "dtype", "scale", "chunk_count", "model")
+            fetched = pipe.execute()
+            chunks = self._fetch_chunks(r, changed, fetched) if CHUNK_MODE != "off" else {}
+
+            new_ids, new_rows = [], []
+            chunk_rows, chunk_owners = [], []
+            for (doc_id, seq), (raw_vec, dtype, scale, _, model) in zip(changed, fetched):
+                self.last_seq = max(self.last_seq, int(seq))
+                if raw_vec is None:
+                    continue
+                doc_id = doc_id.decode('utf-8')
+                if model is not None and model.decode('utf-8') != EMBED_MODEL:
+                    print(f"Skipping doc {doc_id}: embedded with {model.decode('utf-8')}, not {EMBED_MODEL}")
+                    continue
+                vec = decode_embedding(raw_vec, dtype, scale)
+                if vec.shape != (self.matrix.shape[1],):
+                    print(f"Skipping doc {doc_id}: embedding dim {vec.shape} != {self.matrix.shape[1]}")
+                    continue
+                vec = vec / max(float(np.linalg.norm(vec)), 1e-12)
+                if doc_id in self.rows:
+                    # Re-upserted id, overwrite its row in place
+                    self.matrix[self.rows[doc_id]] = vec
+                    # Its old chunks no longer count
+                    self.chunk_owner[self.chunk_owner == self.rows[doc_id]] = -1
+                else:
+                    self.rows[doc_id] = len(self.ids) + len(new_ids)
+                    new_ids.append(doc_id)
+                    new_rows.append(vec)
+                if CHUNK_MODE != "off":
+                    doc_chunks = chunks.get(doc_id) or [vec]
+                    chunk_rows.extend(doc_chunks)
+                    chunk_owners.extend([self.rows[doc_id]] * len(doc_chunks))
+
+            if new_rows:
+                self.matrix = np.ascontiguousarray(np.vstack([self.matrix, np.vstack(new_rows)]))
+                self.ids.extend(new_ids)
+            if chunk_rows:
+                self._append_chunks(chunk_rows, chunk_owners)
+            return len(changed)
+
+    def _fetch_chunks(self, r: Redis, changed, fetched) -> Dict[str, List[np.ndarray]]:
+        """Normalized chunk vectors of the changed documents, keyed by doc id"""
+        pipe = r.pipeline(transaction=False)
+        owners = []
+        for (doc_id, _), (_, _, _, chunk_count, _) in zip(changed, fetched):
+            doc_id = doc_id.decode('utf-8')
+            for j in range(int(chunk_count or 0)):
+                pipe.hmget(_chunk_key(self.list_key, doc_id, j), "embedding", "dtype", "scale")
+                owners.append(doc_id)
+
+        chunks: Dict[str, List[np.ndarray]] = {}
+        for doc_id, (raw_vec, dtype, scale) in zip(owners, pipe.execute() if owners else []):
+            if raw_vec is None:
                 continue
-        
-        if not similarities:
-            print("No valid documents found after processing")
-            return {"documents": [[]], "metadatas": [[]]}
-        
-        # Sort by similarity and get top k
-        similarities.sort(key=lambda x: x['similarity'], reverse=True)
-        top_k = similarities[:k]
-        
-        # Format output like Chroma
-        documents = []
-        metadatas = []
-        for item in top_k:
-            documents.append(item['content'])
-            metadatas.append(item['metadata'])
-        
-        return {
-            "documents": [documents],
-            "metadatas": [metadatas]
-        }
+            vec = decode_embedding(raw_vec, dtype, scale)
+            if vec.shape != (self.chunk_matrix.shape[1],):
+                continue
+            chunks.setdefault(doc_id, []).append(vec / max(float(np.linalg.norm(vec)), 1e-12))
+        return chunks
+
+    def _append_chunks(self, rows: List[np.ndarray], owners: List[int]) -> None:
+        matrix = np.vstack([self.chunk_matrix, np.vstack(rows)])
+        owner = np.concatenate([self.chunk_owner, np.asarray(owners, dtype=np.int64)])
+        # Drop rows orphaned by re-upserts once they make up half the matrix
+        live = owner >= 0
+        if live.sum() * 2 < len(owner):
+            matrix, owner = matrix[live], owner[live]
+        self.chunk_matrix = np.ascontiguousarray(matrix)
+        self.chunk_owner = owner
+
+    def search(self, query_embedding, k: int, candidates: Optional[Set[str]] = None,
+               include_embeddings: bool = False) -> Dict[str, Any]:
+        """Rank rows against the query with one matvec and argpartition.
+
+        When candidates is given only those ids are scored. include_embeddings
+        adds the (normalized) row of each result under "embeddings".
+        """
+        with self._lock:
+            if candidates is None:
+                row_ids = None
+                matrix = self.matrix
+            else:
+                row_ids = np.fromiter((self.rows[c] for c in candidates if c in self.rows), dtype=np.int64)
+                row_ids.sort()
+                matrix = self.matrix[row_ids]
+            n = matrix.shape[0]
+            if n == 0:
+                return {"documents": [[]], "metadatas": [[]]}
+
+            q = np.asarray(query_embedding, dtype=np.float32)
+            q = q / max(float(np.linalg.norm(q)), 1e-12)
+            if CHUNK_MODE != "off":
+                live = self.chunk_owner >= 0
+                owners = self.chunk_owner[live]
+                doc_scores = _aggregate_chunk_scores(owners, self.chunk_matrix[live] @ q, len(self.ids))
+                scores = doc_scores if row_ids is None else doc_scores[row_ids]
+                n = min(n, int(np.isfinite(scores).sum()))
+                if n == 0:
+                    return {"documents": [[]], "metadatas": [[]]}
+            else:
+                scores = matrix @ q
+
+            k = min(k, n)
+            top = np.argpartition(-scores, k - 1)[:k] if k < len(scores) else np.arange(len(scores))
+            top = top[np.argsort(-scores[top])]
+            top_scores = scores[top]
+            if row_ids is not None:
+                top = row_ids[top]
+            ids = [self.ids[i] for i in top]
+            vectors = self.matrix[top] if include_embeddings else None
+
+        # Load content/metadata for the winners only
+        return _load_documents(get_redis(), self.list_key, ids, include_embeddings, vectors, top_scores)
+
+
+_corpora: Dict[str, CorpusMatrix] = {}
+
+
+class LexicalCorpus:
+    """BM25 index over a collection's stored content, refreshed like CorpusMatrix.
+
+    Scan mode only; with the vector index, _lexical_search ranks in RediSearch.
+    """
+
+    def __init__(self, list_key: str):
+        self.list_key = list_key
+        self._lock = threading.RLock()
+        self.reset()
+
+    def reset(self) -> None:
+        with self._lock:
+            self.index = BM25Index()
+            self.last_seq = 0
+            self.epoch = None
+
+    def refresh(self) -> int:
+        r = get_redis()
+        with self._lock:
+            pipe = r.pipeline(transaction=True)
+            pipe.get(_epoch_key(self.list_key))
+            pipe.zrangebyscore(_ids_key(self.list_key), f"({self.last_seq}", "+inf", withscores=True)
+            epoch, changed = pipe.execute()
+            if epoch != self.epoch:
+                if self.epoch is not None or self.last_seq:
+                    self.reset()
+                    return self.refresh()
+                self.epoch = epoch
+            if not changed:
+                return 0
+
+            pipe = r.pipeline(transaction=False)
+            for doc_id, _ in changed:
+                pipe.hget(_doc_prefix(self.list_key) + doc_id.decode('utf-8'), "content")
+            for (doc_id, seq), content in zip(changed, pipe.execute()):
+                self.last_seq = max(self.last_seq, int(seq))
+                if content is not None:
+                    self.index.add(doc_id.decode('utf-8'), content.decode('utf-8'))
+            return len(changed)
+
+    def search(self, query_text: str, n: int, candidates: Optional[Set[str]] = None) -> List[Tuple[str, float]]:
+        with self._lock:
+            return self.index.search(query_text, n, candidates)
+
+
+_lexical: Dict[str, LexicalCorpus] = {}
+
+
+def get_lexical(list_key: str) -> LexicalCorpus:
+    """Shared LexicalCorpus for a namespace, refreshed from Redis on every call"""
+    lexical = _lexical.get(list_key)
+    if lexical is None:
+        lexical = _lexical.setdefault(list_key, LexicalCorpus(list_key))
+    lexical.refresh()
+    return lexical
+
+
+def _lexical_search(list_key: str, query_text: str, n: int,
+                    filters: Optional[Dict[str, Any]] = None) -> List[Tuple[str, float]]:
+    """Top-n (doc id, BM25 score) from the RediSearch full-text index on content.
+
+    Like BM25Index, only RAG_LEXICAL_QUERY_TERMS query terms are sent; without
+    document frequencies at hand the longest ones are kept, which are mostly
+    the codes and names that tell carriers apart.
+    """
+    terms = sorted(set(tokenize(query_text)), key=lambda t: (-len(t), t))[:LEXICAL_QUERY_TERMS]
+    if not terms or n <= 0:
+        return []
+    query = " ".join([f"@content:({'|'.join(terms)})", *_filter_clauses(filters)])
+    reply = get_redis().execute_command(
+        "FT.SEARCH", _index_name(list_key), query, "SCORER", "BM25", "WITHSCORES", "NOCONTENT",
+        "LIMIT", 0, n, "DIALECT", 2,
+    )
+    # Reply layout: [total, key1, score1, key2, score2, ...]
+    prefix = len(_doc_prefix(list_key))
+    return [(key.decode('utf-8')[prefix:], float(score)) for key, score in zip(reply[1::2], reply[2::2])]
+
+
+def _fuse_hybrid(list_key: str, query_embedding, results: Dict[str, Any], lexical_ranked: List[Tuple[str, float]],
+                 k: int, include_embeddings: bool) -> Dict[str, Any]:
+    """Reciprocal rank fusion of the vector and BM25 rankings; scores stay cosine similarities"""
+    fused = reciprocal_rank_fusion([results.get("ids", [[]])[0], [doc_id for doc_id, _ in lexical_ranked]], RRF_K)
+    fused_results = _load_documents(get_redis(), list_key, [doc_id for doc_id, _ in fused[:k]], True)
+    q = np.asarray(query_embedding, dtype=np.float32)
+    q = q / max(float(np.linalg.norm(q)), 1e-12)
+    fused_results["scores"] = [[
+        float(np.dot(vec, q) / max(float(np.linalg.norm(vec)), 1e-12)) for vec in fused_results["embeddings"][0]
+    ]]
+    if not include_embeddings:
+        del fused_results["embeddings"]
+    return fused_results
+
+
+def get_offline_index(list_key: str) -> IVFIndex:
+    index = _offline_indexes.get(list_key)
+    if index is None:
+        index = _offline_indexes.setdefault(list_key, IVFIndex(os.path.join(ANN_DIR, list_key)))
+    return index
+
+
+def _iter_redis_docs(list_key: str, members, page_size: int = 500):
+    """Yield stored documents for (id, seq) pairs, page_size HMGETs per round trip"""
+    r = get_redis()
+    for start in range(0, len(members), page_size):
+        page = members[start:start + page_size]
+        pipe = r.pipeline(transaction=False)
+        for doc_id, _ in page:
+            pipe.hmget(_doc_prefix(list_key) + doc_id.decode('utf-8'),
+                       "content", "metadata", "embedding", "dtype", "scale")
+        for (doc_id, _), (content, metadata, raw_vec, dtype, scale) in zip(page, pipe.execute()):
+            if raw_vec is None:
+                continue
+            yield {
+                "id": doc_id.decode('utf-8'),
+                "content": content.decode('utf-8'),
+                "metadata": json.loads(metadata),
+                "embedding": decode_embedding(raw_vec, dtype, scale),
+            }
+
+
+def sync_offline_index(list_key: str, page_size: int = 500) -> int:
+    """Bring the offline index of a collection up to date with Redis.
+
+    Only documents written since the last sync are appended; a delete (epoch
+    change), a namespace swap or stale centroids trigger a full rebuild.
+    Returns rows written.
+    """
+    r = get_redis()
+    index = get_offline_index(list_key)
+    namespace = resolve_namespace(list_key)
+    epoch = r.get(_epoch_key(namespace))
+    epoch = epoch.decode('utf-8') if epoch is not None else None
+
+    rebuild = index.needs_rebuild() or index.manifest.get("epoch") != epoch \
+        or index.manifest.get("model") != EMBED_MODEL or index.manifest.get("namespace", list_key) != namespace
+    since = 0 if rebuild else index.manifest.get("last_seq", 0)
+    members = r.zrangebyscore(_ids_key(namespace), f"({since}", "+inf", withscores=True)
+    state = {"epoch": epoch, "model": EMBED_MODEL, "namespace": namespace,
+             "last_seq": int(max((seq for _, seq in members), default=since))}
+
+    t0 = time.time()
+    if rebuild:
+        written = index.build(_iter_redis_docs(namespace, members, page_size), EMBED_DIM, state)
+    else:
+        written = index.append(list(_iter_redis_docs(namespace, members, page_size)), state)
+    if written:
+        print(f"✓ Offline index for {list_key}: {'rebuilt with' if rebuild else 'added'} "
+              f"{written} docs in {time.time() - t0:.2f}s")
+    return written
+
+
+def _maybe_sync_offline(list_key: str) -> None:
+    """Kick off a background sync of the offline index if it is due"""
+    if not ANN_DIR:
+        return
+    with _offline_sync_lock:
+        if time.time() - _offline_synced.get(list_key, 0.0) < ANN_SYNC_INTERVAL:
+            return
+        _offline_synced[list_key] = time.time()
+
+    def _sync():
+        try:
+            sync_offline_index(list_key)
+        except Exception as e:
+            print(f"Offline index sync for {list_key} failed: {e}")
+            with _offline_sync_lock:
+                _offline_synced[list_key] = 0.0
+
+    threading.Thread(target=_sync, name=f"ann-sync-{list_key}", daemon=True).start()
+
+
+def _offline_search(list_key: str, query_embedding, k: int,
+                    filters: Optional[Dict[str, Any]] = None,
+                    include_embeddings: bool = False) -> Dict[str, Any]:
+    """search_collection served from the on-disk IVF index"""
+    wanted = {}
+    for field, values in (filters or {}).items():
+        if not isinstance(values, (list, tuple, set)):
+            values = [values]
+        wanted[field] = {_tag_value(v) for v in values}
+
+    def where(metadata: Dict[str, Any]) -> bool:
+        return all(_tag_value(metadata.get(field, "")) in values for field, values in wanted.items())
+
+    hits = get_offline_index(list_key).search(query_embedding, k, where=where if wanted else None,
+                                              include_vectors=include_embeddings)
+    if not hits:
+        print(f"No documents found in the offline index for key: {list_key}")
+    results = {
+        "ids": [[hit["id"] for hit in hits]],
+        "documents": [[hit["content"] for hit in hits]],
+        "metadatas": [[hit["metadata"] for hit in hits]],
+        "scores": [[hit["score"] for hit in hits]]
+    }
+    if include_embeddings:
+        results["embeddings"] = [[hit["embedding"] for hit in hits]]
+    return results
+
+
+def get_corpus(list_key: str) -> CorpusMatrix:
+    """Shared CorpusMatrix for a list key, refreshed from Redis on every call"""
+    corpus = _corpora.get(list_key)
+    if corpus is None:
+        corpus = _corpora.setdefault(list_key, CorpusMatrix(list_key))
+    corpus.refresh()
+    return corpus
+
+
+def _search_namespace(collection: str) -> Optional[str]:
+    """Namespace to search for a collection, None when its vectors come from another model"""
+    namespace, model = _namespace_info(collection)
+    if model is not None and model != EMBED_MODEL:
+        # Never rank a query from one model against vectors of another
+        print(f"Skipping search of {namespace}: stored {model} embeddings, EMBED_MODEL is {EMBED_MODEL}")
+        return None
+    return namespace
+
+
+def _redis_unavailable(collection: str, error: Exception) -> None:
+    """Serve collection from the offline index for the next REDIS_RETRY_AFTER seconds"""
+    global _redis_down_until
+    print(f"Redis unavailable ({error}), serving {collection} from the offline index")
+    _redis_down_until = time.time() + REDIS_RETRY_AFTER
+
+
+def _index_candidates(list_key: str, filters: Optional[Dict[str, Any]]) -> Optional[int]:
+    """How many documents a KNN query ranked over, for the query telemetry"""
+    if not QUERY_STATS:
+        return None
+    allowed = filter_candidates(list_key, filters)
+    return len(allowed) if allowed is not None else get_redis().zcard(_ids_key(list_key))
+
+
+def _search_stats(mode: str, candidates: Optional[int], filters: Optional[Dict[str, Any]],
+                  encode_seconds: Optional[float], search_seconds: float) -> Dict[str, Any]:
+    return {
+        "mode": mode,
+        "candidates": candidates,
+        "filtered": int(bool(filters)),
+        "encode_ms": f"{encode_seconds * 1000:.2f}" if encode_seconds is not None else None,
+        "search_ms": f"{search_seconds * 1000:.2f}",
+    }
+
+
+def search_collection(list_key: str, query_text: str, k: int = 3,
+                      filters: Optional[Dict[str, Any]] = None,
+                      query_embedding: Optional[np.ndarray] = None,
+                      include_embeddings: bool = False,
+                      encode_seconds: Optional[float] = None) -> Dict[str, Any]:
+    """Find the most similar documents of a collection using cosine similarity.
+
+    filters restricts the candidates by metadata before any vector math,
+    e.g. {"shippingLineName": "MSC"} or {"currency": ["USD", "INR"]}.
+    Pass query_embedding when it was already computed (e.g. by embed_query_async),
+    and encode_seconds with it so the query telemetry still has the encode time.
+    Results carry "scores" (cosine similarity); include_embeddings adds the
+    stored vector of each result under "embeddings".
+    While Redis is unreachable the offline index under RAG_ANN_DIR answers instead.
+    """
+    collection = list_key
+    try:
+        # Get query embedding (cached across repeat submissions of the same text)
+        if query_embedding is None:
+            t0 = time.perf_counter()
+            query_embedding = embed_query(query_text)
+            encode_seconds = time.perf_counter() - t0
+
+        if ANN_DIR and time.time() < _redis_down_until:
+            return _offline_search(collection, query_embedding, k, filters, include_embeddings)
+        try:
+            t0 = time.perf_counter()
+            list_key = _search_namespace(collection)
+            if list_key is None:
+                return {"documents": [[]], "metadatas": [[]]}
+            fetch_k = k * HYBRID_OVERSAMPLE if HYBRID else k
+            lexical_ranked = None
+            if ensure_vector_index(list_key):
+                mode = "index"
+                prefiltered = None
+                if HYBRID:
+                    lexical_ranked = _lexical_search(list_key, query_text, max(fetch_k, LEXICAL_PREFILTER), filters)
+                    if LEXICAL_PREFILTER > 0 and len(lexical_ranked) >= k:
+                        mode = "index+lexical"
+                        prefiltered = [doc_id for doc_id, _ in lexical_ranked]
+                    lexical_ranked = lexical_ranked[:fetch_k]
+                results = _knn_search(list_key, query_embedding, fetch_k, filters, include_embeddings, prefiltered)
+                candidates = len(prefiltered) if prefiltered is not None else _index_candidates(list_key, filters)
+            else:
+                mode = "scan"
+                corpus = get_corpus(list_key)
+                if corpus.matrix.shape[0] == 0:
+                    print(f"No documents found in Redis for key: {list_key}")
+                allowed = filter_candidates(list_key, filters)
+                if HYBRID:
+                    lexical_ranked = get_lexical(list_key).search(
+                        query_text, max(fetch_k, LEXICAL_PREFILTER), allowed)
+                    if LEXICAL_PREFILTER > 0 and len(lexical_ranked) >= k:
+                        # Only score vectors of documents sharing rare terms with the query
+                        mode = "scan+lexical"
+                        allowed = {doc_id for doc_id, _ in lexical_ranked}
+                    lexical_ranked = lexical_ranked[:fetch_k]
+                results = corpus.search(query_embedding, fetch_k, allowed, include_embeddings)
+                candidates = len(allowed) if allowed is not None else corpus.matrix.shape[0]
+            if lexical_ranked is not None:
+                results = _fuse_hybrid(list_key, query_embedding, results, lexical_ranked, k, include_embeddings)
+            search_seconds = time.perf_counter() - t0
+        except (RedisConnectionError, RedisTimeoutError) as e:
+            if not ANN_DIR:
+                raise
+            _redis_unavailable(collection, e)
+            return _offline_search(collection, query_embedding, k, filters, include_embeddings)
+
+        _record_query(list_key, results, _search_stats(mode, candidates, filters, encode_seconds, search_seconds))
+        _maybe_sync_offline(collection)
+        return results
     except Exception as e:
-        print(f"Error in comparison_invoice: {e}")
+        print(f"Error searching {list_key}: {e}")
         return {"documents": [[]], "metadatas": [[]]}
 
 
-def rag_invoice_prompt_redis(new_ocr_text: str) -> str:
-    """Build RAG prompt using Redis similarity search"""
+async def search_collection_async(list_key: str, query_text: str, k: int = 3,
+                                  filters: Optional[Dict[str, Any]] = None,
+                                  query_embedding: Optional[np.ndarray] = None,
+                                  include_embeddings: bool = False,
+                                  encode_seconds: Optional[float] = None) -> Dict[str, Any]:
+    """search_collection for async handlers.
+
+    RediSearch queries are awaited on the asyncio client. The in-process scan,
+    hybrid BM25 fusion and the offline index are CPU work, so those run
+    search_collection in a worker thread.
+    """
+    collection = list_key
+    if query_embedding is None:
+        t0 = time.perf_counter()
+        query_embedding = await embed_query_async(query_text)
+        encode_seconds = time.perf_counter() - t0
+
+    def in_thread():
+        return asyncio.to_thread(search_collection, collection, query_text, k, filters,
+                                 query_embedding, include_embeddings, encode_seconds)
+
+    if SEARCH_MODE == "scan" or HYBRID or (ANN_DIR and time.time() < _redis_down_until):
+        return await in_thread()
     try:
-        results = comparison_invoice(new_ocr_text, k=3)
-        
-        doc_txt = results['documents'][0][0] if results['documents'] and results['documents'][0] else ""
-        doc_meta = results['metadatas'][0][0] if results['metadatas'] and results['metadatas'][0] else {}
-        
-        if doc_txt:
-            prompt_rag = f"""
+        t0 = time.perf_counter()
+        list_key = await asyncio.to_thread(_search_namespace, collection)
+        if list_key is None:
+            return {"documents": [[]], "metadatas": [[]]}
+        use_index = _index_ready[list_key] if list_key in _index_ready \
+            else await asyncio.to_thread(ensure_vector_index, list_key)
+        if not use_index:
+            return await in_thread()
+        results = await _knn_search_async(list_key, query_embedding, k, filters, include_embeddings)
+        search_seconds = time.perf_counter() - t0
+        candidates = await asyncio.to_thread(_index_candidates, list_key, filters)
+    except (RedisConnectionError, RedisTimeoutError) as e:
+        if not ANN_DIR:
+            print(f"Error searching {list_key}: {e}")
+            return {"documents": [[]], "metadatas": [[]]}
+        _redis_unavailable(collection, e)
+        return await asyncio.to_thread(_offline_search, collection, query_embedding, k, filters,
+                                       include_embeddings)
+    except Exception as e:
+        print(f"Error searching {list_key}: {e}")
+        return {"documents": [[]], "metadatas": [[]]}
+
+    try:
+        pipe = get_async_redis().pipeline(transaction=False)
+        if _queue_query_record(pipe, list_key, results,
+                               _search_stats("index", candidates, filters, encode_seconds, search_seconds)):
+            await pipe.execute()
+    except Exception as e:
+        print(f"Recording query stats for {list_key} failed: {e}")
+    _maybe_sync_offline(collection)
+    return results
+
+
+def query_stats_summary(list_key: str, bins: int = 10, last: int = QUERY_STATS_MAXLEN) -> Dict[str, Any]:
+    """Histograms and percentiles over the last queries recorded for a collection.
+
+    top1 is the best cosine similarity per query (bins over [0, 1]); a drift
+    down over time suggests the corpus no longer covers incoming documents or
+    the embeddings need rebuilding. hit_rate is the share of queries that
+    returned at least one exemplar.
+    """
+    list_key = resolve_namespace(list_key)
+    entries = get_redis().xrevrange(_stats_key(list_key), count=last)
+    rows = [{key.decode('utf-8'): value.decode('utf-8') for key, value in fields.items()} for _, fields in entries]
+    summary: Dict[str, Any] = {"list_key": list_key, "queries": len(rows)}
+    if not rows:
+        return summary
+
+    summary["hit_rate"] = sum(1 for row in rows if int(row.get("returned", 0)) > 0) / len(rows)
+    summary["modes"] = {}
+    for row in rows:
+        summary["modes"][row.get("mode", "")] = summary["modes"].get(row.get("mode", ""), 0) + 1
+    for metric in ("top1", "candidates", "encode_ms", "search_ms"):
+        values = np.array([float(row[metric]) for row in rows if row.get(metric)], dtype=np.float64)
+        if values.size == 0:
+            continue
+        if metric == "top1":
+            # float32 rounding can put an exact match a hair above 1
+            counts, edges = np.histogram(np.clip(values, 0.0, 1.0), bins=bins, range=(0.0, 1.0))
+        else:
+            counts, edges = np.histogram(values, bins=bins)
+        p50, p95, p99 = np.percentile(values, [50, 95, 99])
+        summary[metric] = {
+            "count": int(values.size),
+            "mean": float(values.mean()),
+            "p50": float(p50), "p95": float(p95), "p99": float(p99),
+            "histogram": {"edges": [round(float(e), 4) for e in edges], "counts": counts.tolist()},
+        }
+    return summary
+
+
+def comparison_invoice(query_text: str, k: int = 3,
+                       filters: Optional[Dict[str, Any]] = None,
+                       query_embedding: Optional[np.ndarray] = None,
+                       include_embeddings: bool = False) -> Dict[str, Any]:
+    """Find most similar invoices using cosine similarity"""
+    return search_collection(INVOICE_LIST_KEY, query_text, k, filters, query_embedding, include_embeddings)
+
+
+def comparison_do(query_text: str, k: int = 3,
+                  filters: Optional[Dict[str, Any]] = None,
+                  query_embedding: Optional[np.ndarray] = None,
+                  include_embeddings: bool = False) -> Dict[str, Any]:
+    """Find most similar delivery/storing orders using cosine similarity"""
+    return search_collection(DO_LIST_KEY, query_text, k, filters, query_embedding, include_embeddings)
+
+
+def select_exemplars(query_embedding, results: Dict[str, Any], k: int = EXEMPLAR_K,
+                     token_budget: int = EXEMPLAR_TOKEN_BUDGET,
+                     mmr_lambda: float = MMR_LAMBDA) -> List[Tuple[str, Dict[str, Any]]]:
+    """Pick up to k (content, metadata) exemplars by maximal marginal relevance.
+
+    Uses the vectors already returned with the search results (include_embeddings),
+    and stops once the next pick would push the exemplars past token_budget
+    tokens. The best match is always kept so the prompt has at least one.
+    """
+    documents = results['documents'][0] if results.get('documents') else []
+    metadatas = results['metadatas'][0] if results.get('metadatas') else []
+    if not documents:
+        return []
+
+    tokens = count_tokens([f"{doc} (Fields: {meta})" for doc, meta in zip(documents, metadatas)])
+    embeddings = results.get('embeddings', [[]])[0]
+    if len(embeddings) == len(documents):
+        vectors = np.vstack(embeddings).astype(np.float32)
+        vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+        q = np.asarray(query_embedding, dtype=np.float32)
+        relevance = vectors @ (q / max(float(np.linalg.norm(q)), 1e-12))
+        similarity = vectors @ vectors.T
+    else:
+        # No vectors to compare, keep the search order
+        relevance = -np.arange(len(documents), dtype=np.float32)
+        similarity = np.zeros((len(documents), len(documents)), dtype=np.float32)
+
+    selected: List[int] = []
+    remaining = list(range(len(documents)))
+    used = 0
+    while remaining and len(selected) < k:
+        redundancy = similarity[np.ix_(remaining, selected)].max(axis=1) if selected else 0.0
+        mmr = mmr_lambda * relevance[remaining] - (1.0 - mmr_lambda) * redundancy
+        best = remaining[int(np.argmax(mmr))]
+        if selected and used + tokens[best] > token_budget:
+            break
+        selected.append(best)
+        used += tokens[best]
+        remaining.remove(best)
+    return [(documents[i], metadatas[i]) for i in selected]
+
+
+def _format_exemplars(exemplars: List[Tuple[str, Dict[str, Any]]]) -> str:
+    return "\n        ".join(f"{i}. {doc} (Fields: {meta})" for i, (doc, meta) in enumerate(exemplars, 1))
+
+
+def _invoice_prompt(new_ocr_text: str, exemplars: List[Tuple[str, Dict[str, Any]]]) -> str:
+    if exemplars:
+        return f"""
         Refer to the previous similar invoices:
-        1. {doc_txt} (Fields: {doc_meta})
+        {_format_exemplars(exemplars)}
 
         Give dates in DD-MM-YYYY format
         NO explanations. JSON ONLY
@@ -149,9 +1985,8 @@ def rag_invoice_prompt_redis(new_ocr_text: str) -> str:
         The text to be analyzed from the document is below-
         {new_ocr_text}
     """
-        else:
-            # Fallback prompt if no similar documents found in Redis
-            prompt_rag = f"""
+    # Fallback prompt if no similar documents found in Redis (or Redis failed)
+    return f"""
         Extract key invoice information from the following document.
 
         Give dates in DD-MM-YYYY format
@@ -161,17 +1996,115 @@ def rag_invoice_prompt_redis(new_ocr_text: str) -> str:
         The text to be analyzed from the document is below-
         {new_ocr_text}
     """
-        return prompt_rag
-    except Exception as e:
-        print(f"Error in rag_invoice_prompt_redis: {e}")
-        # Return a fallback prompt even if Redis fails
+
+
+def _do_prompt(new_ocr_text: str, exemplars: List[Tuple[str, Dict[str, Any]]]) -> str:
+    if exemplars:
         return f"""
-        Extract key invoice information from the following document.
+        Refer to the previous similar documents:
+        {_format_exemplars(exemplars)}
 
         Give dates in DD-MM-YYYY format
         NO explanations. JSON ONLY
-        Return ContainerList and BankAccountDetails as a List of Dictionaries in JSON format
+        Return ContainerList as a List of Dicitonaries like json format
+        The BL Number is a single alphanumeric number
+        The Seal Number is located directly below the Container Number in the table
+        Only Extract the same fields as in similar documents nothing extra
 
+        Only display those fields which are present
         The text to be analyzed from the document is below-
         {new_ocr_text}
     """
+    # Fallback prompt if no similar documents found in Redis
+    return f"""
+        Extract key delivery order / storing order information from the following document.
+
+        Give dates in DD-MM-YYYY format
+        NO explanations. JSON ONLY
+        Return ContainerList as a List of Dictionaries in JSON format
+        The BL Number is a single alphanumeric number
+        The Seal Number is located directly below the Container Number in the table
+
+        Only display those fields which are present
+        The text to be analyzed from the document is below-
+        {new_ocr_text}
+    """
+
+
+def _rag_exemplars(list_key: str, new_ocr_text: str, filters: Optional[Dict[str, Any]] = None,
+                   query_embedding: Optional[np.ndarray] = None) -> List[Tuple[str, Dict[str, Any]]]:
+    """Exemplars for a prompt: filtered search, unfiltered when that finds nothing, then MMR"""
+    encode_seconds = None
+    if query_embedding is None:
+        t0 = time.perf_counter()
+        query_embedding = embed_query(new_ocr_text)
+        encode_seconds = time.perf_counter() - t0
+    results = search_collection(list_key, new_ocr_text, EXEMPLAR_CANDIDATES, filters,
+                                query_embedding, include_embeddings=True, encode_seconds=encode_seconds)
+    if filters and not results['documents'][0]:
+        # Nothing stored for e.g. this carrier yet, any exemplar beats none
+        results = search_collection(list_key, new_ocr_text, EXEMPLAR_CANDIDATES,
+                                    query_embedding=query_embedding, include_embeddings=True)
+    return select_exemplars(query_embedding, results)
+
+
+async def _rag_exemplars_async(list_key: str, new_ocr_text: str, filters: Optional[Dict[str, Any]] = None,
+                               query_embedding: Optional[np.ndarray] = None) -> List[Tuple[str, Dict[str, Any]]]:
+    """_rag_exemplars for async handlers; never blocks the event loop"""
+    encode_seconds = None
+    if query_embedding is None:
+        t0 = time.perf_counter()
+        query_embedding = await embed_query_async(new_ocr_text)
+        encode_seconds = time.perf_counter() - t0
+    results = await search_collection_async(list_key, new_ocr_text, EXEMPLAR_CANDIDATES, filters,
+                                            query_embedding, include_embeddings=True,
+                                            encode_seconds=encode_seconds)
+    if filters and not results['documents'][0]:
+        results = await search_collection_async(list_key, new_ocr_text, EXEMPLAR_CANDIDATES,
+                                                query_embedding=query_embedding, include_embeddings=True)
+    return await asyncio.to_thread(select_exemplars, query_embedding, results)
+
+
+def _rag_prompt(list_key: str, build_prompt, new_ocr_text: str, filters: Optional[Dict[str, Any]] = None,
+                query_embedding: Optional[np.ndarray] = None) -> str:
+    try:
+        exemplars = _rag_exemplars(list_key, new_ocr_text, filters, query_embedding)
+    except Exception as e:
+        print(f"Error building the RAG prompt from {list_key}: {e}")
+        exemplars = []
+    return build_prompt(new_ocr_text, exemplars)
+
+
+async def _rag_prompt_async(list_key: str, build_prompt, new_ocr_text: str,
+                            filters: Optional[Dict[str, Any]] = None,
+                            query_embedding: Optional[np.ndarray] = None) -> str:
+    try:
+        exemplars = await _rag_exemplars_async(list_key, new_ocr_text, filters, query_embedding)
+    except Exception as e:
+        print(f"Error building the RAG prompt from {list_key}: {e}")
+        exemplars = []
+    return build_prompt(new_ocr_text, exemplars)
+
+
+def rag_invoice_prompt_redis(new_ocr_text: str, filters: Optional[Dict[str, Any]] = None,
+                             query_embedding: Optional[np.ndarray] = None) -> str:
+    """Build RAG prompt using Redis similarity search"""
+    return _rag_prompt(INVOICE_LIST_KEY, _invoice_prompt, new_ocr_text, filters, query_embedding)
+
+
+async def rag_invoice_prompt_redis_async(new_ocr_text: str, filters: Optional[Dict[str, Any]] = None,
+                                         query_embedding: Optional[np.ndarray] = None) -> str:
+    """rag_invoice_prompt_redis for async handlers; never blocks the event loop"""
+    return await _rag_prompt_async(INVOICE_LIST_KEY, _invoice_prompt, new_ocr_text, filters, query_embedding)
+
+
+def rag_do_prompt_redis(new_ocr_text: str, filters: Optional[Dict[str, Any]] = None,
+                        query_embedding: Optional[np.ndarray] = None) -> str:
+    """Build DO RAG prompt using Redis similarity search"""
+    return _rag_prompt(DO_LIST_KEY, _do_prompt, new_ocr_text, filters, query_embedding)
+
+
+async def rag_do_prompt_redis_async(new_ocr_text: str, filters: Optional[Dict[str, Any]] = None,
+                                    query_embedding: Optional[np.ndarray] = None) -> str:
+    """rag_do_prompt_redis for async handlers; never blocks the event loop"""
+    return await _rag_prompt_async(DO_LIST_KEY, _do_prompt, new_ocr_text, filters, query_embedding)
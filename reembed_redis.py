@@ -0,0 +1,203 @@
+import re
+import json
+import time
+import argparse
+from typing import Dict, Any, Iterable
+
+from redis_rag_setup import (
+    INVOICE_LIST_KEY,
+    DO_LIST_KEY,
+    EMBED_MODEL,
+    bulk_upsert,
+    get_redis,
+    swap_namespace,
+    drop_namespace,
+    ensure_vector_index,
+    wait_for_index,
+    _active_key,
+    _previous_key,
+    _meta_key,
+    _ids_key,
+    _doc_prefix,
+    _last_hit_key,
+    _hits_key,
+    _pinned_key,
+    _delete_documents,
+)
+
+
+COLLECTIONS = {"invoice": INVOICE_LIST_KEY, "do": DO_LIST_KEY}
+
+
+def _active_namespace(list_key: str) -> str:
+    active = get_redis().get(_active_key(list_key))
+    return active.decode('utf-8') if active else list_key
+
+
+def _stored_model(namespace: str):
+    model = get_redis().hget(_meta_key(namespace), "model")
+    return model.decode('utf-8') if model else None
+
+
+def _copied_key(target: str) -> str:
+    return f"{target}:copied"
+
+
+def _read_contents(namespace: str, members, page_size: int) -> Iterable[Dict[str, Any]]:
+    """Stored content/metadata of (id, seq) pairs; vectors are left behind to be re-encoded"""
+    r = get_redis()
+    for start in range(0, len(members), page_size):
+        page = members[start:start + page_size]
+        pipe = r.pipeline(transaction=False)
+        for doc_id, _ in page:
+            pipe.hmget(_doc_prefix(namespace) + doc_id.decode('utf-8'), "content", "metadata")
+        for (doc_id, _), (content, metadata) in zip(page, pipe.execute()):
+            if content is None:
+                continue  # deleted since the id list was read
+            yield {"id": doc_id.decode('utf-8'), "content": content.decode('utf-8'),
+                   "metadata": json.loads(metadata) if metadata else {}}
+
+
+def copy_new_documents(target: str, page_size: int = 500, batch_size: int = 64) -> int:
+    """Re-encode documents written to the target's source since the last copy; returns how many"""
+    r = get_redis()
+    source, copied_seq = r.hmget(_meta_key(target), "source", "copied_seq")
+    source = source.decode('utf-8')
+    since = int(copied_seq or 0)
+    members = r.zrangebyscore(_ids_key(source), f"({since}", "+inf", withscores=True)
+    if not members:
+        return 0
+    bulk_upsert(_read_contents(source, members, page_size), target, batch_size=batch_size, chunk_size=page_size)
+    # Remember which ids came from the source: only those may later be
+    # dropped because the source deleted them
+    r.sadd(_copied_key(target), *[doc_id for doc_id, _ in members])
+    r.hset(_meta_key(target), "copied_seq", int(max(seq for _, seq in members)))
+    return len(members)
+
+
+def _carry_over_usage(source: str, target: str) -> None:
+    """Keep pins and retrieval history so retention behaves the same after the swap"""
+    r = get_redis()
+    r.sunionstore(_pinned_key(target), [_pinned_key(target), _pinned_key(source)])
+    r.zunionstore(_last_hit_key(target), [_last_hit_key(target), _last_hit_key(source)], aggregate="MAX")
+    hits = r.hgetall(_hits_key(source))
+    if hits:
+        r.hset(_hits_key(target), mapping=hits)
+
+
+def _drop_deleted(source: str, target: str) -> int:
+    """Remove copied documents that have since been deleted from the source.
+
+    Documents written straight to the target (by servers already on the new
+    model) were never copied, so they are left alone.
+    """
+    r = get_redis()
+    copied = list(r.smembers(_copied_key(target)))
+    if not copied:
+        return 0
+    pipe = r.pipeline(transaction=False)
+    for doc_id in copied:
+        pipe.zscore(_ids_key(source), doc_id)
+    gone = [doc_id for doc_id, seq in zip(copied, pipe.execute()) if seq is None]
+    if not gone:
+        return 0
+    r.srem(_copied_key(target), *gone)
+    return _delete_documents(target, [doc_id.decode('utf-8') for doc_id in gone])
+
+
+def reembed_collection(list_key: str, page_size: int = 500, batch_size: int = 64) -> str:
+    """Re-encode a collection with the current EMBED_MODEL into a shadow namespace, then swap.
+
+    Servers keep reading and writing the active namespace while the copy runs.
+    Documents written meanwhile are picked up by repeated catch-up passes; once
+    a pass is small the active pointer is swapped atomically and a last pass
+    copies whatever raced the swap. Servers still on the old model keep using
+    the previous namespace until restarted; run --catch-up after the rollout
+    to copy what they wrote in between.
+    """
+    r = get_redis()
+    source = _active_namespace(list_key)
+    if _stored_model(source) == EMBED_MODEL:
+        print(f"{list_key} is already embedded with {EMBED_MODEL}")
+        return source
+
+    model_slug = re.sub(r"[^\w.-]+", "_", EMBED_MODEL)
+    target = f"{list_key}@{model_slug}-{int(time.time())}"
+    r.hset(_meta_key(target), mapping={"source": source, "copied_seq": 0})
+    print(f"Re-embedding {source} -> {target} with {EMBED_MODEL}")
+
+    t0 = time.time()
+    # Create the target's indexes while it is empty, so every copied hash is
+    # indexed as it is written rather than by a background scan after the swap
+    ensure_vector_index(target)
+    copied = copy_new_documents(target, page_size, batch_size)
+    while True:
+        # Writes that landed during the previous pass
+        delta = copy_new_documents(target, page_size, batch_size)
+        copied += delta
+        if delta < page_size:
+            break
+
+    _carry_over_usage(source, target)
+    if not wait_for_index(target):
+        raise RuntimeError(f"Index for {target} did not finish building; {list_key} is still served from {source}")
+    swap_namespace(list_key, target)
+    copied += copy_new_documents(target, page_size, batch_size)
+    dropped = _drop_deleted(source, target)
+    print(f"✓ {list_key} now served from {target}: {copied} docs re-embedded, "
+          f"{dropped} deleted meanwhile, {time.time() - t0:.1f}s")
+    return target
+
+
+def catch_up(list_key: str, page_size: int = 500, batch_size: int = 64) -> int:
+    """Copy writes the previous namespace received after the swap into the active one"""
+    target = _active_namespace(list_key)
+    if get_redis().hget(_meta_key(target), "source") is None:
+        print(f"{list_key} has not been re-embedded, nothing to catch up")
+        return 0
+    copied = copy_new_documents(target, page_size, batch_size)
+    source = get_redis().hget(_meta_key(target), "source").decode('utf-8')
+    dropped = _drop_deleted(source, target)
+    print(f"✓ {list_key}: caught up {copied} docs, dropped {dropped} deleted")
+    return copied
+
+
+def drop_previous(list_key: str) -> int:
+    """Delete the namespace the last swap retired (once no server uses the old model)"""
+    r = get_redis()
+    previous = r.get(_previous_key(list_key))
+    if not previous:
+        print(f"{list_key} has no previous namespace")
+        return 0
+    removed = drop_namespace(previous.decode('utf-8'))
+    r.delete(_previous_key(list_key))
+    print(f"✓ Dropped {previous.decode('utf-8')} ({removed} keys)")
+    return removed
+
+
+def main():
+    ap = argparse.ArgumentParser(
+        description="Re-encode the Redis RAG collections with EMBED_MODEL and swap them in without downtime")
+    ap.add_argument("--collection", choices=[*COLLECTIONS, "all"], default="all")
+    ap.add_argument("--page-size", type=int, default=500, help="Documents read and written per round")
+    ap.add_argument("--batch-size", type=int, default=64, help="Encode batch size")
+    ap.add_argument("--catch-up", action="store_true",
+                    help="Only copy writes the previous namespace got after the swap")
+    ap.add_argument("--drop-previous", action="store_true",
+                    help="Delete the retired namespace (after all servers run the new model)")
+    args = ap.parse_args()
+
+    names = list(COLLECTIONS) if args.collection == "all" else [args.collection]
+    for name in names:
+        list_key = COLLECTIONS[name]
+        if args.catch_up or args.drop_previous:
+            if args.catch_up:
+                catch_up(list_key, args.page_size, args.batch_size)
+            if args.drop_previous:
+                drop_previous(list_key)
+        else:
+            reembed_collection(list_key, args.page_size, args.batch_size)
+
+
+if __name__ == "__main__":
+    main()
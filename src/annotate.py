@@ -1,7 +1,7 @@
 """
 annotate.py
 -----------
-Build an annotated PDF from page PNG bytes:
+Build an annotated PDF from page PNG bytes (or raw RGB pages):
   - red rectangles = blocks
   - optional thin gray rectangles = words (debug)
 """
@@ -10,6 +10,7 @@ from pathlib import Path
 from typing import List, Dict, Any
 from PIL import Image, ImageDraw
 import io
+import fitz  # PyMuPDF
 
 def annotate_pages_to_pdf_from_bytes(
     page_png_bytes: List[bytes],      # list of page images as PNG-encoded bytes
@@ -54,4 +55,42 @@ def annotate_pages_to_pdf_from_bytes(
     if images:
         first, rest = images[0], images[1:]
         # resolution=300 hints a good default DPI for viewing/printing
-        first.save(out_pdf.as_posix(), save_all=True, append_images=rest, resolution=300)
\ No newline at end of file
+        first.save(out_pdf.as_posix(), save_all=True, append_images=rest, resolution=300)
+
+
+def annotate_page_rgb_to_png(
+    page_rgb: Dict[str, Any],         # {"rgb": bytes, "width", "height"} (pdf_utils.iter_rgb_pages)
+    page_words: Dict[str, Any],
+    page_blocks: Dict[str, Any],
+    draw_words: bool = False,
+) -> bytes:
+    """
+    Draw one page's blocks (and optionally words) on its raw pixels and return
+    the annotated page as PNG bytes, so a streaming caller can keep the
+    compressed page instead of the raw image.
+    """
+    im = Image.frombytes("RGB", (page_rgb["width"], page_rgb["height"]), page_rgb["rgb"])
+    dr = ImageDraw.Draw(im)
+    for b in page_blocks.get("blocks", []):
+        dr.rectangle(b[1], outline="red", width=3)
+    if draw_words:
+        for w in page_words.get("texts", []):
+            dr.rectangle(w["bbox"], outline=(180, 180, 180), width=1)
+    bio = io.BytesIO()
+    im.save(bio, format="PNG")
+    return bio.getvalue()
+
+
+def write_png_pages_to_pdf(pages: List[Dict[str, Any]], out_pdf: Path, resolution: int = 300):
+    """
+    Assemble a PDF from {"png": bytes, "width", "height"} pages. PyMuPDF embeds
+    the PNG streams as they are, so no page is decoded back to raw pixels.
+    """
+    out_pdf.parent.mkdir(parents=True, exist_ok=True)
+    if not pages:
+        return
+    with fitz.open() as doc:
+        for p in pages:
+            page = doc.new_page(width=p["width"] * 72.0 / resolution, height=p["height"] * 72.0 / resolution)
+            page.insert_image(page.rect, stream=p["png"])
+        doc.save(out_pdf.as_posix())
\ No newline at end of file
@@ -0,0 +1,291 @@
+"""
+ocr_cache.py
+------------
+Content-addressed cache of per-page OCR results, shared by RapidOCR
+(run_rapid4) and Tesseract (document_processing_services.tessaract_ocr).
+
+Every entry carries the DPI and the engine name and version. Pages are looked
+up first by sha256(pdf bytes) + page index, so a re-run of the same S3 object
+(or a duplicate email) skips OCR without parsing the PDF. On a miss, the page
+fingerprint is tried next: a hash of everything the page draws (content
+streams and every object reachable from its resources and annotations, fonts
+and font files included). A partially changed document therefore only OCRs
+the pages that changed.
+
+Two tiers, both optional:
+  OCR_CACHE_DIR        local directory; entries are zlib-compressed JSON
+  OCR_CACHE_MAX_MB     size cap for the directory, least recently used evicted (default 512)
+  OCR_CACHE_REDIS_URL  Redis shared between hosts (entries expire after OCR_CACHE_REDIS_TTL s)
+With neither set, get_ocr_cache() returns None and OCR runs uncached.
+"""
+
+import hashlib
+import json
+import os
+import re
+import threading
+import zlib
+from functools import lru_cache
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Union
+
+import fitz  # PyMuPDF
+
+
+OCR_CACHE_DIR = os.getenv("OCR_CACHE_DIR", "")
+OCR_CACHE_MAX_BYTES = int(float(os.getenv("OCR_CACHE_MAX_MB", "512")) * 1024 * 1024)
+OCR_CACHE_REDIS_URL = os.getenv("OCR_CACHE_REDIS_URL", "")
+OCR_CACHE_REDIS_TTL = int(os.getenv("OCR_CACHE_REDIS_TTL", str(30 * 24 * 3600)))
+
+# Bump when the fingerprint or entry layout changes
+_FORMAT = 2
+
+
+# ---------- compact word lists ----------
+def pack_words(words: List[Dict[str, Any]]) -> List[list]:
+    """[{"text", "bbox", "confidence"}] -> [[text, x0, y0, x1, y1, conf], ...]"""
+    return [
+        [w["text"], *[round(float(v), 1) for v in w["bbox"]],
+         None if w.get("confidence") is None else round(float(w["confidence"]), 4)]
+        for w in words
+    ]
+
+
+def unpack_words(packed: List[list]) -> List[Dict[str, Any]]:
+    return [{"text": t, "bbox": [x0, y0, x1, y1], "confidence": c} for t, x0, y0, x1, y1, c in packed]
+
+
+# ---------- engine versions ----------
+@lru_cache(maxsize=None)
+def rapidocr_version() -> str:
+    try:
+        from importlib.metadata import version
+        return "rapidocr-" + version("rapidocr_onnxruntime")
+    except Exception:
+        return "rapidocr-unknown"
+
+
+@lru_cache(maxsize=None)
+def tesseract_version() -> str:
+    try:
+        import pytesseract
+        return f"tesseract-{pytesseract.get_tesseract_version()}"
+    except Exception:
+        return "tesseract-unknown"
+
+
+# ---------- fingerprints ----------
+def file_sha256(pdf_path: Union[str, Path]) -> str:
+    h = hashlib.sha256()
+    with open(pdf_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+_REF = re.compile(r"(\d+) \d+ R")
+
+
+def _page_key_value(doc: "fitz.Document", xref: int, key: str) -> str:
+    """A page's entry for key, looked up through /Parent when it is inherited"""
+    seen = set()
+    while xref and xref not in seen:
+        seen.add(xref)
+        kind, value = doc.xref_get_key(xref, key)
+        if kind != "null":
+            return value
+        kind, parent = doc.xref_get_key(xref, "Parent")
+        xref = int(parent.split()[0]) if kind == "xref" else 0
+    return ""
+
+
+def page_fingerprint(doc: "fitz.Document", page: "fitz.Page") -> str:
+    """
+    sha256 of what the page draws: geometry, content streams, and every
+    object reachable from its /Resources and /Annots - fonts, embedded font
+    files, ToUnicode maps, images and form XObjects. Objects are hashed by
+    their definition and raw (still compressed) stream, so nothing is rendered.
+    Two pages with identical content streams but different subset fonts get
+    different fingerprints. Object numbers are left out (objects are hashed in
+    walk order instead), so a rewritten file that renumbers objects still
+    matches.
+    """
+    h = hashlib.sha256()
+    h.update(repr((tuple(page.rect), page.rotation)).encode())
+    for xref in page.get_contents():
+        h.update(doc.xref_stream_raw(xref) or b"")
+
+    # The page object itself is "seen" so /P back-references stop the walk
+    seen = {page.xref}
+    roots = [_page_key_value(doc, page.xref, "Resources"), _page_key_value(doc, page.xref, "Annots")]
+    todo = []
+    for root in reversed(roots):
+        h.update(_REF.sub("R", root).encode())
+        todo.extend(int(ref) for ref in reversed(_REF.findall(root)))
+    while todo:
+        xref = todo.pop()
+        if xref in seen:
+            continue
+        seen.add(xref)
+        obj = doc.xref_object(xref, compressed=True)
+        h.update(_REF.sub("R", obj).encode())
+        if doc.xref_is_stream(xref):
+            h.update(doc.xref_stream_raw(xref) or b"")
+        todo.extend(int(ref) for ref in reversed(_REF.findall(obj)))
+    return h.hexdigest()
+
+
+# ---------- storage tiers ----------
+class DiskLRU:
+    """Directory of compressed entries with a total size cap; reads refresh mtime, oldest go first"""
+
+    def __init__(self, root: Union[str, Path], max_bytes: int = OCR_CACHE_MAX_BYTES):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._size: Optional[int] = None
+
+    def _path(self, key: str) -> Path:
+        digest = hashlib.sha256(key.encode()).hexdigest()
+        return self.root / digest[:2] / f"{digest}.z"
+
+    def _entries(self):
+        for path in self.root.glob("*/*.z"):
+            try:
+                yield path, path.stat()
+            except FileNotFoundError:
+                continue
+
+    def get(self, key: str) -> Optional[bytes]:
+        path = self._path(key)
+        try:
+            data = path.read_bytes()
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return data
+
+    def put(self, key: str, data: bytes) -> None:
+        path = self._path(key)
+        path.parent.mkdir(exist_ok=True)
+        try:
+            replaced = path.stat().st_size
+        except FileNotFoundError:
+            replaced = 0
+        tmp = path.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+        tmp.write_bytes(data)
+        os.replace(tmp, path)
+        with self._lock:
+            if self._size is None:
+                self._size = sum(st.st_size for _, st in self._entries())
+            else:
+                self._size += len(data) - replaced
+            if self._size > self.max_bytes:
+                self._evict()
+
+    def _evict(self) -> None:
+        # Other processes share the directory, so recount from disk
+        entries = sorted(self._entries(), key=lambda e: e[1].st_mtime)
+        size = sum(st.st_size for _, st in entries)
+        target = int(self.max_bytes * 0.9)
+        for path, st in entries:
+            if size <= target:
+                break
+            try:
+                path.unlink()
+                size -= st.st_size
+            except FileNotFoundError:
+                pass
+        self._size = size
+
+
+class OCRCache:
+    """Disk and/or Redis tiers behind one get/put; lookups fall through disk -> Redis"""
+
+    def __init__(self, disk: Optional[DiskLRU] = None, redis_url: str = "", redis_ttl: int = OCR_CACHE_REDIS_TTL):
+        self.disk = disk
+        self.redis = None
+        self.redis_ttl = redis_ttl
+        if redis_url:
+            from redis import Redis
+            self.redis = Redis.from_url(redis_url, socket_timeout=2.0, socket_connect_timeout=2.0)
+
+    def get(self, key: str) -> Optional[Any]:
+        data = self.disk.get(key) if self.disk is not None else None
+        if data is None and self.redis is not None:
+            try:
+                data = self.redis.get("ocr_cache:" + key)
+            except Exception as e:
+                print(f"OCR cache: Redis get failed ({e})")
+            if data is not None and self.disk is not None:
+                self.disk.put(key, data)
+        if data is None:
+            return None
+        try:
+            return json.loads(zlib.decompress(data))
+        except (zlib.error, ValueError):
+            return None
+
+    def put(self, key: str, value: Any) -> None:
+        data = zlib.compress(json.dumps(value, ensure_ascii=False, separators=(",", ":")).encode("utf-8"), 6)
+        if self.disk is not None:
+            self.disk.put(key, data)
+        if self.redis is not None:
+            try:
+                self.redis.set("ocr_cache:" + key, data, ex=self.redis_ttl)
+            except Exception as e:
+                print(f"OCR cache: Redis set failed ({e})")
+
+    def document(self, pdf_path: Union[str, Path], dpi: int, engine: str) -> "DocumentPages":
+        return DocumentPages(self, pdf_path, dpi, engine)
+
+
+class DocumentPages:
+    """Cache entries of one PDF's pages for one engine and DPI"""
+
+    def __init__(self, cache: OCRCache, pdf_path: Union[str, Path], dpi: int, engine: str):
+        self.cache = cache
+        self.pdf_path = pdf_path
+        self.prefix = f"v{_FORMAT}:{engine}:{dpi}"
+        self.file_sha = file_sha256(pdf_path)
+        self._fingerprints: Optional[List[str]] = None
+
+    def _exact_key(self, page_idx: int) -> str:
+        return f"{self.prefix}:doc:{self.file_sha}:{page_idx}"
+
+    def _page_key(self, page_idx: int) -> str:
+        if self._fingerprints is None:
+            # Only parsed when the file itself is not (fully) in the cache
+            with fitz.open(self.pdf_path) as doc:
+                self._fingerprints = [page_fingerprint(doc, page) for page in doc]
+        return f"{self.prefix}:page:{self._fingerprints[page_idx]}"
+
+    def get(self, page_idx: int) -> Optional[Any]:
+        value = self.cache.get(self._exact_key(page_idx))
+        if value is None:
+            value = self.cache.get(self._page_key(page_idx))
+            if value is not None:
+                self.cache.put(self._exact_key(page_idx), value)
+        return value
+
+    def put(self, page_idx: int, value: Any) -> None:
+        self.cache.put(self._exact_key(page_idx), value)
+        self.cache.put(self._page_key(page_idx), value)
+
+
+_cache: Optional[OCRCache] = None
+_cache_lock = threading.Lock()
+
+
+def get_ocr_cache() -> Optional[OCRCache]:
+    """The process-wide cache, or None when neither tier is configured"""
+    global _cache
+    if not (OCR_CACHE_DIR or OCR_CACHE_REDIS_URL):
+        return None
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                disk = DiskLRU(OCR_CACHE_DIR) if OCR_CACHE_DIR else None
+                _cache = OCRCache(disk, OCR_CACHE_REDIS_URL)
+    return _cache
@@ -176,6 +176,15 @@ def extract_words_from_rgb(img_rgb: np.ndarray) -> List[Dict[str, Any]]:
     return out
 
 
+def rgb_from_buffer(buf, width: int, height: int) -> np.ndarray:
+    """
+    Wrap raw RGB samples (bytes, memoryview or shared-memory buffer) as an
+    (H,W,3) uint8 array without copying. The array borrows `buf`, so it must
+    be dropped before a shared-memory buffer is closed.
+    """
+    return np.frombuffer(buf, dtype=np.uint8, count=height * width * 3).reshape(height, width, 3)
+
+
 def decode_png_bytes_to_rgb(png_bytes: bytes) -> np.ndarray:
     """
     Decode PNG bytes into an RGB numpy array using OpenCV.
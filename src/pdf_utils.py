@@ -4,15 +4,33 @@ pdf_utils.py
 Render PDF pages to **in-memory PNG bytes** (no disk I/O).
 This allows us to pass images directly to OCR engines without
 saving temporary files on disk (faster + cleaner).
+
+`iter_rgb_pages` / `pdf_to_rgb_pages` skip the PNG step entirely and give
+the raw RGB samples, for callers that hand pixels straight to OCR.
+
+`iter_rgb_pages_parallel` renders on a long-lived pool of PDF_RENDER_WORKERS
+processes, or as many as the caller asks for (one pool per size; each worker
+keeps its own fitz.Document open), and still yields pages in
+order. With shared=True the pixels stay in the shared-memory block the worker
+rendered into, which the caller releases with `release_pixels`.
 """
 
+import os
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
 from pathlib import Path
-from typing import List, Dict
+from typing import List, Dict, Iterator, Optional, Tuple
 import io
 import fitz  # PyMuPDF
 from PIL import Image
 
 
+PDF_RENDER_WORKERS = int(os.getenv("PDF_RENDER_WORKERS", "2"))
+
+
 def pdf_to_png_bytes(pdf_path: Path, dpi: int = 200) -> List[Dict]:
     """
     Render a PDF into a list of pages, each page stored as a dict:
@@ -63,4 +81,156 @@ def pdf_to_png_bytes(pdf_path: Path, dpi: int = 200) -> List[Dict]:
                 "height": pix.height     # pixel height
             })
 
-    return out
\ No newline at end of file
+    return out
+
+
+def pdf_page_count(pdf_path: Path) -> int:
+    with fitz.open(pdf_path) as doc:
+        return doc.page_count
+
+
+def iter_rgb_pages(pdf_path: Path, dpi: int = 200, page_numbers: Optional[List[int]] = None) -> Iterator[Dict]:
+    """
+    Render a PDF one page at a time into raw RGB pages (no encoding):
+      {"rgb": bytes, "width": int, "height": int}
+    "rgb" is the pixmap's samples, height * width * 3 bytes, row-major.
+    Only the page being rendered is held, so consumers control peak memory.
+    page_numbers (0-based) restricts rendering to those pages, in that order.
+    """
+    with fitz.open(pdf_path) as doc:
+        zoom = dpi / 72.0
+        mat = fitz.Matrix(zoom, zoom)
+        for page_idx in (range(doc.page_count) if page_numbers is None else page_numbers):
+            pix = doc[page_idx].get_pixmap(matrix=mat, alpha=False)
+            yield {"rgb": pix.samples, "width": pix.width, "height": pix.height}
+
+
+def pdf_to_rgb_pages(pdf_path: Path, dpi: int = 200) -> List[Dict]:
+    """All pages of iter_rgb_pages as a list"""
+    return list(iter_rgb_pages(pdf_path, dpi=dpi))
+
+
+# ---------- raw pixels in shared memory ----------
+def share_pixels(rgb) -> Optional[SharedMemory]:
+    """Copy raw page pixels into a new shared-memory block; None if /dev/shm has no room"""
+    try:
+        shm = SharedMemory(create=True, size=len(rgb))
+    except OSError:
+        return None
+    try:
+        # Reserve the pages up front: a full tmpfs would otherwise only show up
+        # as SIGBUS on the write below
+        if hasattr(os, "posix_fallocate"):
+            os.posix_fallocate(shm._fd, 0, len(rgb))
+    except OSError:
+        shm.close()
+        shm.unlink()
+        return None
+    shm.buf[:len(rgb)] = rgb
+    return shm
+
+
+def release_pixels(shm: Optional[SharedMemory]) -> None:
+    if shm is not None:
+        shm.close()
+        shm.unlink()
+
+
+# ---------- parallel rendering ----------
+_render_pools: Dict[int, ProcessPoolExecutor] = {}
+_render_pool_lock = threading.Lock()
+
+# Per worker process: the document it currently has open
+_worker_doc: Optional[Tuple[Tuple, "fitz.Document"]] = None
+
+
+def get_render_pool(workers: Optional[int] = None) -> ProcessPoolExecutor:
+    """The shared pool of `workers` render processes (default PDF_RENDER_WORKERS)"""
+    workers = PDF_RENDER_WORKERS if workers is None else workers
+    pool = _render_pools.get(workers)
+    if pool is None:
+        with _render_pool_lock:
+            pool = _render_pools.get(workers)
+            if pool is None:
+                # Workers must share this process's resource tracker; one of their
+                # own would unlink our shared-memory pages when the worker exits
+                resource_tracker.ensure_running()
+                pool = _render_pools[workers] = ProcessPoolExecutor(max_workers=workers)
+    return pool
+
+
+def shutdown_render_pool(wait: bool = True) -> None:
+    with _render_pool_lock:
+        pools = list(_render_pools.values())
+        _render_pools.clear()
+    for pool in pools:
+        pool.shutdown(wait=wait, cancel_futures=True)
+
+
+def _open_cached(pdf_path: str) -> "fitz.Document":
+    # Reopen when the file changes (uploads reuse temp names)
+    global _worker_doc
+    st = os.stat(pdf_path)
+    key = (pdf_path, st.st_mtime_ns, st.st_size)
+    if _worker_doc is None or _worker_doc[0] != key:
+        if _worker_doc is not None:
+            _worker_doc[1].close()
+        _worker_doc = (key, fitz.open(pdf_path))
+    return _worker_doc[1]
+
+
+def _render_page_task(pdf_path: str, page_idx: int, dpi: int, shared: bool):
+    zoom = dpi / 72.0
+    pix = _open_cached(pdf_path)[page_idx].get_pixmap(matrix=fitz.Matrix(zoom, zoom), alpha=False)
+    shm = share_pixels(pix.samples_mv) if shared else None
+    if shm is None:
+        return None, pix.samples, pix.width, pix.height
+    name = shm.name
+    shm.close()  # the consumer attaches by name and unlinks
+    return name, None, pix.width, pix.height
+
+
+def iter_rgb_pages_parallel(pdf_path: Path, dpi: int = 200, workers: Optional[int] = None,
+                            shared: bool = False, page_numbers: Optional[List[int]] = None) -> Iterator[Dict]:
+    """
+    Like iter_rgb_pages, but pages are rendered ahead on a pool of `workers`
+    processes and yielded in page order. Page i goes to whichever worker is free, with at
+    most 2 x workers pages rendered ahead of the consumer.
+
+    With shared=True each page may also carry "shm" (a SharedMemory whose
+    buffer is "rgb"); the consumer owns it and must call release_pixels.
+    Falls back to iter_rgb_pages for workers <= 1 or single-page jobs.
+    """
+    workers = PDF_RENDER_WORKERS if workers is None else workers
+    if page_numbers is None:
+        page_numbers = list(range(pdf_page_count(pdf_path)))
+    if workers <= 1 or len(page_numbers) <= 1:
+        yield from iter_rgb_pages(pdf_path, dpi=dpi, page_numbers=page_numbers)
+        return
+
+    pool = get_render_pool(workers)
+    path = os.path.abspath(str(pdf_path))
+    pending = deque()
+    next_i = 0
+    try:
+        while next_i < len(page_numbers) or pending:
+            while next_i < len(page_numbers) and len(pending) < 2 * workers:
+                pending.append(pool.submit(_render_page_task, path, page_numbers[next_i], dpi, shared))
+                next_i += 1
+            name, rgb, width, height = pending.popleft().result()
+            if name is None:
+                yield {"rgb": rgb, "width": width, "height": height}
+                continue
+            shm = SharedMemory(name=name)
+            yield {"rgb": shm.buf, "width": width, "height": height, "shm": shm}
+    finally:
+        # Consumer stopped early: drop pages rendered ahead
+        for fut in pending:
+            if fut.cancel():
+                continue
+            try:
+                name = fut.result()[0]
+            except Exception:
+                continue
+            if name is not None:
+                release_pixels(SharedMemory(name=name))
@@ -4,23 +4,92 @@ run_rapid4.py
 Refactored to be used as both a command-line script and an importable library.
 
 The main function `run_ocr_pipeline` returns the path(s) to the output _blocks.json file(s).
+
+OCR runs on one long-lived pool of RapidOCR worker processes shared by every
+PDF and request in the process (OCR_ENGINES workers, default: CPU count capped
+at 4). Each worker loads the ONNX models once; `shutdown_ocr_pool` stops them.
+Pages reach the workers as raw RGB pixels in shared memory, so nothing is
+PNG-encoded or decoded on the way. Rendering is streamed: page i is rendered
+while earlier pages are in OCR, with at most OCR_MAX_INFLIGHT pages held, and
+rendering itself runs on PDF_RENDER_WORKERS processes (pdf_utils), which write
+pixels straight into the shared memory the OCR workers read. With an OCR cache
+configured (src.ocr_cache), only pages not seen before are OCR'd.
 """
 
 import json
 import os
+import threading
 import time
+from contextlib import closing
 from pathlib import Path
 from typing import List, Dict, Any, Tuple, Union, Optional
-from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
 
 from tqdm import tqdm
-from src.pdf_utils import pdf_to_png_bytes
-from src.ocr_rapid import init_rapidocr_once, decode_png_bytes_to_rgb, extract_words_from_rgb
+from src.pdf_utils import (
+    iter_rgb_pages_parallel, pdf_page_count, share_pixels, release_pixels, shutdown_render_pool,
+)
+from src.ocr_rapid import init_rapidocr_once, rgb_from_buffer, extract_words_from_rgb
 from src.blocks import words_to_blocks, merge_key_value_blocks
-from src.annotate import annotate_pages_to_pdf_from_bytes
+from src.annotate import annotate_page_rgb_to_png, write_png_pages_to_pdf
+from src.ocr_cache import get_ocr_cache, rapidocr_version, pack_words, unpack_words
 from src.layout import words_to_paragraphs
 
 
+OCR_ENGINES = int(os.getenv("OCR_ENGINES", "0")) or max(1, min(4, os.cpu_count() or 1))
+# Rendered pages waiting for or in OCR per PDF (default 2 x OCR_ENGINES)
+OCR_MAX_INFLIGHT = int(os.getenv("OCR_MAX_INFLIGHT", "0"))
+
+_ocr_pool: Optional[ProcessPoolExecutor] = None
+_ocr_pool_lock = threading.Lock()
+
+
+def get_ocr_pool() -> ProcessPoolExecutor:
+    """The shared RapidOCR worker pool, started on first use"""
+    global _ocr_pool
+    if _ocr_pool is None:
+        with _ocr_pool_lock:
+            if _ocr_pool is None:
+                # Start the resource tracker first so workers inherit it (see pdf_utils.get_render_pool)
+                resource_tracker.ensure_running()
+                _ocr_pool = ProcessPoolExecutor(max_workers=OCR_ENGINES, initializer=_engine_initializer)
+    return _ocr_pool
+
+
+def warm_up_ocr_pool(wait: bool = False) -> None:
+    """Start all OCR workers now instead of on the first PDF.
+
+    Each submitted no-op spawns one worker, whose initializer loads the models;
+    with wait=False that happens in the background.
+    """
+    pool = get_ocr_pool()
+    futures = [pool.submit(time.sleep, 0.1) for _ in range(OCR_ENGINES)]
+    if wait:
+        for fut in futures:
+            fut.result()
+        print(f"✓ RapidOCR pool ready ({OCR_ENGINES} engines)")
+
+
+def shutdown_ocr_pool(wait: bool = True) -> None:
+    global _ocr_pool
+    with _ocr_pool_lock:
+        pool, _ocr_pool = _ocr_pool, None
+    if pool is not None:
+        pool.shutdown(wait=wait, cancel_futures=True)
+
+
+def _discard_broken_pool(pool: ProcessPoolExecutor) -> None:
+    # A crashed worker breaks the whole executor; the next PDF starts a fresh one
+    global _ocr_pool
+    with _ocr_pool_lock:
+        if _ocr_pool is pool:
+            _ocr_pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
 # MODIFIED: Now returns a tuple (elapsed_time, blocks_json_path)
 def process_pdf(
     pdf_path: Path,
@@ -33,6 +102,7 @@ def process_pdf(
     min_conf: Optional[float],
     draw_words: bool,
     annotate: bool,
+    render_workers: Optional[int] = None,
 ) -> Tuple[float, Path]:
     """
     Processes a single PDF file and returns its processing time and output JSON path.
@@ -42,46 +112,109 @@ def process_pdf(
     out_root = output_dir / stem
     out_root.mkdir(parents=True, exist_ok=True)
 
-    # 1) Render all pages
-    pages = pdf_to_png_bytes(pdf_path, dpi=dpi)
-    num_pages = len(pages)
+    # 1) Pages are rendered lazily, one at a time, as OCR capacity frees up.
+    #    Pages already in the OCR cache (see src.ocr_cache) are not OCR'd
+    #    again, and not even rendered unless they are annotated.
+    num_pages = pdf_page_count(pdf_path)
     if num_pages == 0:
         # Return a dummy path if the PDF is empty
         return 0.0, out_root / f"{stem}_blocks.json"
 
-    # 2) Set up and run parallel OCR
-    TOTAL_ENGINES = 4
-    engines_used = min(TOTAL_ENGINES, num_pages)
+    cache = get_ocr_cache()
+    cached_pages = cache.document(pdf_path, dpi, rapidocr_version()) if cache is not None else None
+    cached: Dict[int, Dict[str, Any]] = {}
+    if cached_pages is not None:
+        for i in range(num_pages):
+            entry = cached_pages.get(i)
+            if entry is not None:
+                cached[i] = entry
+    to_render = list(range(num_pages)) if annotate else [i for i in range(num_pages) if i not in cached]
+
+    # 2) Stream render -> OCR -> blocks on the shared engine pool. At most
+    #    max_inflight rendered pages exist at once, so peak memory does not
+    #    grow with the page count.
+    TOTAL_ENGINES = OCR_ENGINES
+    engines_used = min(TOTAL_ENGINES, num_pages - len(cached))
     engines_idle = TOTAL_ENGINES - engines_used
-    engines = [ProcessPoolExecutor(max_workers=1, initializer=_engine_initializer) for _ in range(TOTAL_ENGINES)]
-    futures = {}
-    for i, p in enumerate(pages):
-        eng_id = i % TOTAL_ENGINES
-        fut = engines[eng_id].submit(_ocr_page_task, i, p["png"], min_conf)
-        futures[fut] = (eng_id, i)
-
-    results: Dict[int, Dict[str, Any]] = {}
-    for fut in tqdm(as_completed(list(futures.keys())), total=len(futures), desc=f"OCR {stem} ({TOTAL_ENGINES} engines)"):
-        _, page_idx = futures[fut]
-        page_idx_ret, words = fut.result()
-        w, h = pages[page_idx]["width"], pages[page_idx]["height"]
-        results[page_idx_ret] = {"texts": words, "width": w, "height": h}
-    
-    for ex in engines:
-        ex.shutdown(wait=True)
-
-    # 3) Build ordered list of pages
-    pages_json: List[Dict[str, Any]] = []
-    for i in range(num_pages):
-        pj = results.get(i, {"texts": [], "width": pages[i]["width"], "height": pages[i]["height"]})
-        pages_json.append({"page_num": i + 1, "width": pj["width"], "height": pj["height"], "texts": pj["texts"]})
-
-    # 4) Merge words to blocks (two-pass)
-    pages_blocks: List[Dict[str, Any]] = []
-    for p in pages_json:
-        primitive_blocks = words_to_blocks(p["texts"], gap_x=gap_x, gap_y=gap_y)
+    max_inflight = max(TOTAL_ENGINES, OCR_MAX_INFLIGHT or 2 * TOTAL_ENGINES)
+    pool = get_ocr_pool()
+    pages_json: Dict[int, Dict[str, Any]] = {}
+    pages_blocks: Dict[int, Dict[str, Any]] = {}
+    annotated: Dict[int, Dict[str, Any]] = {}
+    inflight: Dict[Future, Tuple[int, Dict[str, Any], Optional[SharedMemory]]] = {}
+    progress = tqdm(total=num_pages, desc=f"OCR {stem} ({TOTAL_ENGINES} engines)")
+
+    def _finish_page(page_idx: int, width: int, height: int, words: List[Dict[str, Any]],
+                     page: Optional[Dict[str, Any]]) -> None:
+        # 3) + 4) Each page gets its words and blocks as soon as its OCR is back
+        if min_conf is not None:
+            words = [w for w in words if (w.get("confidence") is None or w["confidence"] >= min_conf)]
+        pj = {"page_num": page_idx + 1, "width": width, "height": height, "texts": words}
+        primitive_blocks = words_to_blocks(words, gap_x=gap_x, gap_y=gap_y)
         final_blocks = merge_key_value_blocks(primitive_blocks, kv_gap_x=kv_gap_x, kv_gap_y=kv_gap_y)
-        pages_blocks.append({"page_num": p["page_num"], "blocks": final_blocks})
+        pages_json[page_idx] = pj
+        pages_blocks[page_idx] = {"page_num": page_idx + 1, "blocks": final_blocks}
+        if annotate:
+            png = annotate_page_rgb_to_png(page, pj, pages_blocks[page_idx], draw_words=draw_words)
+            annotated[page_idx] = {"png": png, "width": width, "height": height}
+        progress.update(1)
+
+    def _finish_ocr(done) -> None:
+        for fut in done:
+            page_idx, page, shm = inflight.pop(fut)
+            try:
+                _, words = fut.result()
+                if cached_pages is not None:
+                    # Cached before the min_conf filter, which is applied per run
+                    cached_pages.put(page_idx,
+                                     {"width": page["width"], "height": page["height"], "words": pack_words(words)})
+                _finish_page(page_idx, page["width"], page["height"], words, page)
+            finally:
+                page = None
+                release_pixels(shm)
+
+    try:
+        if not annotate:
+            for i, entry in cached.items():
+                _finish_page(i, entry["width"], entry["height"], unpack_words(entry["words"]), None)
+        with closing(iter_rgb_pages_parallel(pdf_path, dpi=dpi, workers=render_workers, shared=True,
+                                             page_numbers=to_render)) as rendered:
+            for i, page in zip(to_render, rendered):
+                if i in cached:
+                    # Rendered for annotation only
+                    entry = cached[i]
+                    try:
+                        _finish_page(i, entry["width"], entry["height"], unpack_words(entry["words"]), page)
+                    finally:
+                        release_pixels(page.get("shm"))
+                    continue
+                # Pages from the render pool are already in shared memory
+                shm = page.get("shm") or share_pixels(page["rgb"])
+                if shm is not None:
+                    fut = pool.submit(_ocr_page_task, i, shm.name, None, page["width"], page["height"])
+                else:
+                    # No room in shared memory: the pixels are pickled to the worker instead
+                    fut = pool.submit(_ocr_page_task, i, None, page["rgb"], page["width"], page["height"])
+                if not annotate:
+                    page = {"width": page["width"], "height": page["height"]}
+                inflight[fut] = (i, page, shm)
+                while len(inflight) >= max_inflight:
+                    done, _ = wait(list(inflight), return_when=FIRST_COMPLETED)
+                    _finish_ocr(done)
+        while inflight:
+            done, _ = wait(list(inflight), return_when=FIRST_COMPLETED)
+            _finish_ocr(done)
+    except BrokenProcessPool:
+        _discard_broken_pool(pool)
+        raise
+    finally:
+        progress.close()
+        for fut, (_, _, shm) in inflight.items():
+            fut.cancel()
+            release_pixels(shm)
+
+    pages_json = [pages_json[i] for i in sorted(pages_json)]
+    pages_blocks = [pages_blocks[i] for i in sorted(pages_blocks)]
 
     # 5) Write outputs
     words_json = {"document": pdf_path.name, "dpi": dpi, "pages": pages_json}
@@ -97,14 +230,11 @@ def process_pdf(
     (out_root / f"{stem}_paragraphs.txt").write_text("\n\n".join(paras), encoding="utf-8")
 
     if annotate:
-        page_png_bytes = [p["png"] for p in pages]
-        annotate_pages_to_pdf_from_bytes(
-            page_png_bytes, pages_json, pages_blocks, out_root / f"{stem}_annotated.pdf", draw_words=draw_words
-        )
+        write_png_pages_to_pdf([annotated[i] for i in sorted(annotated)], out_root / f"{stem}_annotated.pdf")
 
     # 6) Log timing
     elapsed = time.time() - t0
-    msg = f"{stem}: {elapsed:.2f}s | pages={num_pages} | engines_total={TOTAL_ENGINES} used={engines_used} idle={engines_idle}"
+    msg = f"{stem}: {elapsed:.2f}s | pages={num_pages} | cached={len(cached)} | engines_total={TOTAL_ENGINES} used={engines_used} idle={engines_idle}"
     print("DONE", msg)
     (output_dir / "times.txt").parent.mkdir(parents=True, exist_ok=True)
     with open(output_dir / "times.txt", "a", encoding="utf-8") as f:
@@ -113,17 +243,26 @@ def process_pdf(
     # Return both the time and the path
     return elapsed, blocks_json_path
 
-# Helper functions for the OCR workers (no changes here)
+# Helper functions for the OCR workers
 def _engine_initializer():
     os.environ["OMP_NUM_THREADS"] = "1"; os.environ["OPENBLAS_NUM_THREADS"] = "1"; os.environ["MKL_NUM_THREADS"] = "1"
     os.environ["VECLIB_MAXIMUM_THREADS"] = "1"; os.environ["NUMEXPR_NUM_THREADS"] = "1"
     init_rapidocr_once()
 
-def _ocr_page_task(page_idx: int, png_bytes: bytes, min_conf: Optional[float]) -> Tuple[int, List[Dict[str, Any]]]:
-    rgb = decode_png_bytes_to_rgb(png_bytes)
-    words = extract_words_from_rgb(rgb)
-    if min_conf is not None:
-        words = [w for w in words if (w.get("confidence") is None or w["confidence"] >= min_conf)]
+def _ocr_page_task(page_idx: int, shm_name: Optional[str], pixels: Optional[bytes], width: int,
+                   height: int) -> Tuple[int, List[Dict[str, Any]]]:
+    shm = SharedMemory(name=shm_name) if shm_name is not None else None
+    rgb = None
+    try:
+        rgb = rgb_from_buffer(shm.buf if shm is not None else pixels, width, height)
+        words = extract_words_from_rgb(rgb)
+    finally:
+        rgb = None  # the array borrows the shared buffer; drop it before closing
+        if shm is not None:
+            try:
+                shm.close()
+            except BufferError:
+                pass  # a traceback still holds the array; the mapping goes with it
     return page_idx, words
 
 
@@ -140,11 +279,13 @@ def run_ocr_pipeline(
     min_conf: Optional[float] = None,
     draw_words: bool = False,
     annotate: bool = True,
+    render_workers: Optional[int] = None,
 ) -> Optional[Union[Path, List[Path]]]:
     """
     High-level function to run the OCR pipeline.
     Returns the Path to the created _blocks.json file.
     If input is a directory, returns a List of Paths.
+    render_workers overrides PDF_RENDER_WORKERS (<= 1 renders in this process).
     """
     input_path = Path(input_path)
     output_dir = Path(output_dir)
@@ -155,7 +296,8 @@ def run_ocr_pipeline(
 
     if input_path.is_file() and input_path.suffix.lower() == ".pdf":
         elapsed, json_path = process_pdf(
-            input_path, output_dir, dpi, gap_x, gap_y, kv_gap_x, kv_gap_y, min_conf, draw_words, annotate
+            input_path, output_dir, dpi, gap_x, gap_y, kv_gap_x, kv_gap_y, min_conf, draw_words, annotate,
+            render_workers,
         )
         total_time += elapsed
         return_value = json_path
@@ -168,7 +310,8 @@ def run_ocr_pipeline(
         json_paths = []
         for pdf in pdfs:
             elapsed, json_path = process_pdf(
-                pdf, output_dir, dpi, gap_x, gap_y, kv_gap_x, kv_gap_y, min_conf, draw_words, annotate
+                pdf, output_dir, dpi, gap_x, gap_y, kv_gap_x, kv_gap_y, min_conf, draw_words, annotate,
+                render_workers,
             )
             total_time += elapsed
             json_paths.append(json_path)
@@ -185,7 +328,7 @@ def run_ocr_pipeline(
 # --- Main function for command-line use (no changes needed) ---
 def main():
     import argparse
-    ap = argparse.ArgumentParser(description="RapidOCR-only with exactly 4 engines (parallel, page_index%4 assignment)")
+    ap = argparse.ArgumentParser(description="RapidOCR-only with a pool of OCR_ENGINES engines (parallel, one page per task)")
     ap.add_argument("--input", type=str, required=True, help="PDF file or folder")
     ap.add_argument("--output", type=str, required=True, help="Output directory")
     ap.add_argument("--dpi", type=int, default=200, help="Render DPI (higher = sharper but slower)")
@@ -196,20 +339,26 @@ def main():
     ap.add_argument("--min-conf", type=float, default=None, help="Drop words below this confidence (None = keep all)")
     ap.add_argument("--draw-words", action="store_true", help="Draw thin gray word boxes on annotated PDF")
     ap.add_argument("--no-annotate", action="store_true", help="Skip annotated PDF for maximum speed")
+    ap.add_argument("--render-workers", type=int, default=None, help="Page render processes (default PDF_RENDER_WORKERS)")
     args = ap.parse_args()
 
-    run_ocr_pipeline(
-        input_path=args.input,
-        output_dir=args.output,
-        dpi=args.dpi,
-        gap_x=args.gap_x,
-        gap_y=args.gap_y,
-        kv_gap_x=args.kv_gap_x,
-        kv_gap_y=args.kv_gap_y,
-        min_conf=args.min_conf,
-        draw_words=args.draw_words,
-        annotate=(not args.no_annotate),
-    )
+    try:
+        run_ocr_pipeline(
+            input_path=args.input,
+            output_dir=args.output,
+            dpi=args.dpi,
+            gap_x=args.gap_x,
+            gap_y=args.gap_y,
+            kv_gap_x=args.kv_gap_x,
+            kv_gap_y=args.kv_gap_y,
+            min_conf=args.min_conf,
+            draw_words=args.draw_words,
+            annotate=(not args.no_annotate),
+            render_workers=args.render_workers,
+        )
+    finally:
+        shutdown_ocr_pool()
+        shutdown_render_pool()
 
 
 if __name__ == "__main__":